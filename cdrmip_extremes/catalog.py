@@ -0,0 +1,333 @@
+import os
+import json
+import pickle
+import sqlite3
+import hashlib
+
+import numpy as np
+import xarray as xr
+import netCDF4 as nc
+import cftime
+
+from cdrmip_extremes.configs import data_dir, models, expts
+
+catalog_path = os.path.join(data_dir, 'catalog.sqlite')
+
+# marker in the names of files already remapped onto the common 2º grid, which may sit
+# alongside the native-grid files of the same record
+common_grid = 'r180x90'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    stage TEXT,
+    variable TEXT,
+    experiment TEXT,
+    model TEXT,
+    grid TEXT,
+    dims TEXT,
+    chunking TEXT,
+    ntime INTEGER,
+    time_start TEXT,
+    time_end TEXT,
+    time_order REAL,
+    calendar TEXT,
+    time_units TEXT,
+    time_decoded BLOB,
+    size INTEGER,
+    mtime REAL,
+    checksum TEXT
+)
+"""
+
+# variables and experiments each raw record is expected to cover
+expected_raw = {
+    'tas': expts,
+    'mrsos': expts[:2],
+    'siconc': expts[:2],
+    'msftmz-msftyz': expts,
+}
+
+
+def connect(db_path=None, create=False):
+    """
+    Opens the catalog. Only build_catalog creates it, so reading before it has
+    been built raises FileNotFoundError rather than leaving an empty catalog behind.
+    """
+    db_path = db_path or catalog_path
+    if not create and not os.path.exists(db_path):
+        raise FileNotFoundError(f"No catalog at {db_path}, run build_catalog() first")
+    con = sqlite3.connect(db_path)
+    con.row_factory = sqlite3.Row
+    con.execute(_schema)
+    return con
+
+
+def file_checksum(path, blocksize=2**23):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_path(path, root=data_dir):
+    """
+    Infers (stage, variable, experiment, model) from a path under data/, following
+    the layout data/<stage>/<variable>/[<experiment>/][<model>/]<model>_....nc
+    """
+    parts = os.path.relpath(path, root).split(os.sep)
+    stage = parts[0]
+    variable = parts[1] if len(parts) > 2 else None
+    experiment = next((p for p in parts[2:-1] if p in expts), None)
+    fname = parts[-1]
+    model = next((p for p in parts[2:-1] if p in models), None)
+    if model is None:
+        matches = [m for m in models if fname.startswith(f"{m}_")]
+        model = max(matches, key=len) if matches else None
+    if experiment is None:
+        matches = [e for e in expts if f"_{e}_" in fname]
+        experiment = max(matches, key=len) if matches else None
+    return stage, variable, experiment, model
+
+
+def read_header(path):
+    """
+    Reads dimensions, chunking and the decoded time axis of a NetCDF file without
+    loading any data variables
+    """
+    with nc.Dataset(path) as f:
+        dims = {name: len(dim) for name, dim in f.dimensions.items()}
+        chunking = {}
+        for name, var in f.variables.items():
+            if name in f.dimensions or 'bnds' in name or 'bounds' in name:
+                continue
+            chunks = var.chunking()
+            chunking[name] = chunks if isinstance(chunks, list) else str(chunks)
+
+        time = None
+        if 'time' in f.variables and len(f.variables['time']) > 0:
+            tvar = f.variables['time']
+            units = tvar.units
+            calendar = getattr(tvar, 'calendar', 'standard')
+            decoded = cftime.num2date(
+                tvar[:], units, calendar, only_use_cftime_datetimes=True
+            )
+            time = {
+                'units': units,
+                'calendar': calendar,
+                'decoded': decoded,
+            }
+
+    horizontal = [d for d in dims if d not in ('time', 'bnds', 'nv', 'vertices', 'axis_nbounds')]
+    grid = 'x'.join(f"{d}{dims[d]}" for d in horizontal)
+    return dims, chunking, grid, time
+
+
+def build_catalog(root=data_dir, db_path=None, checksum=True):
+    """
+    Indexes every NetCDF file under data/raw and data/processed into a local
+    SQLite catalog. Files whose size and modification time are unchanged since
+    the last build are skipped, so rebuilding is cheap.
+    """
+    con = connect(db_path, create=True)
+    known = {
+        row['path']: (row['size'], row['mtime'])
+        for row in con.execute('SELECT path, size, mtime FROM files')
+    }
+    seen = set()
+    for stage in ['raw', 'processed']:
+        for dirpath, _, fnames in os.walk(os.path.join(root, stage)):
+            for fname in sorted(fnames):
+                if not fname.endswith('.nc'):
+                    continue
+                path = os.path.normpath(os.path.join(dirpath, fname))
+                seen.add(path)
+                stat = os.stat(path)
+                if known.get(path) == (stat.st_size, stat.st_mtime):
+                    continue
+
+                dims, chunking, grid, time = read_header(path)
+                row = dict(zip(
+                    ['stage', 'variable', 'experiment', 'model'],
+                    parse_path(path, root)
+                ))
+                row.update({
+                    'path': path,
+                    'grid': grid,
+                    'dims': json.dumps(dims),
+                    'chunking': json.dumps(chunking),
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'checksum': file_checksum(path) if checksum else None,
+                    'ntime': 0,
+                    'time_start': None,
+                    'time_end': None,
+                    'time_order': None,
+                    'calendar': None,
+                    'time_units': None,
+                    'time_decoded': None,
+                })
+                if time is not None:
+                    decoded = time['decoded']
+                    row.update({
+                        'ntime': len(decoded),
+                        'time_start': decoded[0].isoformat(),
+                        'time_end': decoded[-1].isoformat(),
+                        'time_order': float(cftime.date2num(
+                            decoded[0], 'days since 0001-01-01', time['calendar']
+                        )),
+                        'calendar': time['calendar'],
+                        'time_units': time['units'],
+                        'time_decoded': pickle.dumps(decoded),
+                    })
+                con.execute(
+                    f"INSERT OR REPLACE INTO files ({', '.join(row)}) "
+                    f"VALUES ({', '.join('?' * len(row))})",
+                    list(row.values())
+                )
+
+    # drop files that no longer exist
+    for path in set(known) - seen:
+        con.execute('DELETE FROM files WHERE path = ?', (path,))
+    con.commit()
+    return con
+
+
+def is_regridded(path):
+    return common_grid in os.path.basename(path)
+
+
+def query(db_path=None, regridded=None, **filters):
+    """
+    Returns catalog rows matching the given column values, ordered by start time.
+    regridded=True keeps only the common-grid (r180x90) copies and regridded=False
+    only the native-grid files.
+    """
+    con = connect(db_path)
+    where = ' AND '.join(f"{key} = ?" for key in filters) or '1'
+    rows = con.execute(
+        f"SELECT * FROM files WHERE {where} ORDER BY time_order, path",
+        list(filters.values())
+    ).fetchall()
+    con.close()
+    if regridded is not None:
+        rows = [row for row in rows if is_regridded(row['path']) == regridded]
+    return rows
+
+
+def _is_current(row):
+    try:
+        stat = os.stat(row['path'])
+    except FileNotFoundError:
+        return False
+    return (stat.st_size, stat.st_mtime) == (row['size'], row['mtime'])
+
+
+def _open_rows(rows, **kwargs):
+    kwargs.setdefault('decode_times', False)
+    dss = [xr.open_dataset(row['path'], **kwargs) for row in rows]
+    if len(dss) == 1:
+        ds = dss[0]
+    else:
+        ds = xr.concat(
+            dss,
+            dim='time',
+            data_vars='minimal',
+            coords='minimal',
+            compat='override',
+            join='override',
+        )
+    if 'time' in ds.dims and rows[0]['time_decoded'] is not None:
+        decoded = np.concatenate([pickle.loads(row['time_decoded']) for row in rows])
+        ds = ds.assign_coords(time=xr.CFTimeIndex(decoded))
+    return ds
+
+
+def open_dataset(model, experiment, variable, stage='raw', db_path=None, regridded=None, **kwargs):
+    """
+    Opens the record for a model/experiment/variable from the catalog. Files are
+    combined in catalogued time order and the pre-decoded time axis is attached,
+    so neither a directory scan nor cftime decoding is needed. Where native-grid
+    and r180x90 files of the same record are both catalogued, regridded selects
+    which of them to open.
+    """
+    rows = query(
+        db_path, regridded, stage=stage, model=model, experiment=experiment, variable=variable
+    )
+    if not rows:
+        raise FileNotFoundError(
+            f"No catalogued files for {model} {experiment} {variable} ({stage})"
+        )
+    if len({is_regridded(row['path']) for row in rows}) > 1:
+        raise ValueError(
+            f"{model} {experiment} {variable} has both native and {common_grid} files, "
+            "pass regridded=True or False"
+        )
+    if not all(_is_current(row) for row in rows):
+        raise FileNotFoundError(
+            f"Files for {model} {experiment} {variable} have changed since the catalog was built"
+        )
+    return _open_rows(rows, **kwargs)
+
+
+def open_path(path, db_path=None, **kwargs):
+    """
+    Opens a single catalogued file, e.g. a processed product, with its pre-decoded time axis
+    """
+    rows = query(db_path, path=os.path.normpath(path))
+    if not rows or not _is_current(rows[0]):
+        raise FileNotFoundError(f"{path} is not catalogued or has changed since the catalog was built")
+    return _open_rows(rows, **kwargs)
+
+
+def check_catalog(db_path=None, records=None):
+    """
+    Returns a list of problems with the raw records in the catalog: missing
+    model/experiment combinations (e.g. a missing branch), gaps or overlaps
+    between consecutive files of a multi-file record, and models whose grid
+    differs between experiments. Native-grid and r180x90 copies of a record are
+    checked as separate records.
+    """
+    records = expected_raw if records is None else records
+    problems = []
+    for variable, var_expts in records.items():
+        grids = {}
+        for model in models:
+            for expt in var_expts:
+                rows = query(db_path, stage='raw', model=model, experiment=expt, variable=variable)
+                if not rows:
+                    problems.append(f"{variable}: missing {expt} for {model}")
+                    continue
+                for regridded in (False, True):
+                    record = [row for row in rows if is_regridded(row['path']) == regridded]
+                    if not record:
+                        continue
+                    grids.setdefault((model, regridded), set()).update(row['grid'] for row in record)
+                    for prev, row in zip(record[:-1], record[1:]):
+                        prev_end = pickle.loads(prev['time_decoded'])[-1]
+                        start = pickle.loads(row['time_decoded'])[0]
+                        step = (start - prev_end).days
+                        if not 27 <= step <= 32:
+                            problems.append(
+                                f"{variable}: {model} {expt} has a {step} day step between "
+                                f"{os.path.basename(prev['path'])} and {os.path.basename(row['path'])}"
+                            )
+        for (model, regridded), model_grids in grids.items():
+            if len(model_grids) > 1:
+                label = common_grid if regridded else 'native'
+                problems.append(
+                    f"{variable}: {model} {label} grid differs between experiments {sorted(model_grids)}"
+                )
+    return problems
+
+
+def require_complete(db_path=None, records=None):
+    """
+    Raises before a long run starts if any expected raw record is missing or inconsistent
+    """
+    problems = check_catalog(db_path, records)
+    if problems:
+        raise FileNotFoundError(
+            "Catalog is incomplete or inconsistent:\n  " + "\n  ".join(problems)
+        )
@@ -0,0 +1,223 @@
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from cdrmip_extremes.configs import data_dir, models, expts
+from cdrmip_extremes import catalog, ext_freq
+from cdrmip_extremes import regrid as rg
+from cdrmip_extremes.time_index import add_calendar_coords, year_coord
+
+daily_dir = os.path.join(data_dir, 'processed/daily')
+
+# daily variable and annual block statistic used for each extreme type:
+# TXx (annual maximum of daily maximum temperature) and TNn (annual minimum of daily minimum)
+daily_vars = {'heat': 'tasmax', 'cold': 'tasmin'}
+ext_types = ['heat', 'cold']
+# keys of the threshold dicts, as returned by daily_thresholds and load_data.load_threshold_data
+threshold_keys = {ext_type: f"{ext_type}_thresholds" for ext_type in ext_types}
+
+
+def daily_files(model, expt, var, regridded=True):
+    """
+    Returns the daily files for a model/experiment/variable in time order, from the
+    catalog where it has been built and otherwise from data/raw/<var>/<expt>.
+    Files already on the common grid carry r180x90 in their name.
+    """
+    paths = []
+    if os.path.exists(catalog.catalog_path):
+        paths = [
+            row['path'] for row in
+            catalog.query(regridded=regridded, stage='raw', model=model, experiment=expt, variable=var)
+        ]
+    if not paths:
+        paths = sorted(glob.glob(
+            os.path.join(data_dir, 'raw', var, expt, f"{model}_{expt}_day_{var}*.nc")
+        ))
+        paths = [path for path in paths if catalog.is_regridded(path) == regridded]
+    return paths
+
+
+def _as_thresholds(thresholds, shape):
+    """
+    Broadcasts scalar, per-threshold or gridded thresholds to (threshold, lat, lon),
+    returning them with a label for each threshold. A Dataset of threshold1..3, as
+    returned by ext_freq.heat_extreme_thresholds, is labelled by variable name.
+    """
+    if isinstance(thresholds, xr.Dataset):
+        thresholds = thresholds.to_array('threshold').transpose('threshold', 'lat', 'lon')
+    thr = np.asarray(getattr(thresholds, 'values', thresholds), dtype=float)
+    if isinstance(thresholds, xr.DataArray) and 'threshold' in thresholds.coords:
+        labels = thresholds['threshold'].values
+    elif thr.ndim < 2:
+        labels = thr.ravel()
+    else:
+        labels = np.arange(1 if thr.ndim == 2 else thr.shape[0])
+    if thr.ndim < 2:
+        thr = thr.reshape(-1, 1, 1)
+    elif thr.ndim == 2:
+        thr = thr[None]
+    return np.broadcast_to(thr, thr.shape[:1] + shape), labels
+
+
+def annual_reduce(paths, var, ext_type, thresholds=None, weights=None, min_days=360):
+    """
+    Streams daily files once, one year at a time, reducing each year to the block
+    maximum (heat) or minimum (cold) of every cell and, optionally, the number of
+    days above (heat) or below (cold) each threshold. Only a single year of daily
+    data is held in memory, and years split across files are merged.
+
+    Inputs:
+    paths: daily files in time order
+    var: variable to read, e.g. 'tasmax' or 'tasmin'
+    ext_type: 'heat' or 'cold'
+    thresholds: scalar, list, (threshold, lat, lon) array or Dataset of threshold1..3
+        (e.g. from daily_thresholds) for the day counts
+    weights: regridding weights from regrid.get_weights, if the files are on their native grid
+    min_days: years with fewer days than this (e.g. partial first or last years) are set to NaN
+    Outputs:
+    Dataset with 'block' (year, lat, lon), 'ndays' (year) and, if thresholds are
+    given, 'exceed_days' (threshold, year, lat, lon), labelled by the threshold values
+    or, for gridded thresholds, their names
+    """
+    if ext_type not in ext_types:
+        raise ValueError("ext_type must be 'heat' or 'cold'")
+    reduce = np.fmax if ext_type == 'heat' else np.fmin
+    blocks, ndays, days = {}, {}, {}
+    lat = lon = thr = labels = None
+
+    for path in paths:
+        with xr.open_dataset(path, use_cftime=True) as ds:
+            da = ds[var]
+            years = add_calendar_coords(ds)[year_coord].values
+            edges = np.concatenate([[0], np.flatnonzero(np.diff(years)) + 1, [len(years)]])
+            for start, end in zip(edges[:-1], edges[1:]):
+                block = da.isel(time=slice(start, end))
+                if weights is not None:
+                    block = rg.regrid(block, weights)
+                if lat is None:
+                    lat, lon = block['lat'].values, block['lon'].values
+                    if thresholds is not None:
+                        thr, labels = _as_thresholds(thresholds, (len(lat), len(lon)))
+                x = block.values
+
+                year = int(years[start])
+                ext = reduce.reduce(x, axis=0)
+                blocks[year] = ext if year not in blocks else reduce(blocks[year], ext)
+                ndays[year] = ndays.get(year, 0) + (end - start)
+                if thr is not None:
+                    beyond = x[None] > thr[:, None] if ext_type == 'heat' else x[None] < thr[:, None]
+                    days[year] = days.get(year, 0) + beyond.sum(axis=1)
+
+    years = np.array(sorted(blocks))
+    complete = np.array([ndays[year] >= min_days for year in years])
+    out = xr.Dataset(
+        {
+            'block': (
+                ('year', 'lat', 'lon'),
+                np.where(complete[:, None, None], np.stack([blocks[y] for y in years]), np.nan)
+            ),
+            'ndays': ('year', np.array([ndays[y] for y in years])),
+        },
+        coords={'year': years, 'lat': lat, 'lon': lon}
+    )
+    if thr is not None:
+        out = out.assign_coords(threshold=labels)
+        out['exceed_days'] = (
+            ('threshold', 'year', 'lat', 'lon'),
+            np.where(
+                complete[None, :, None, None],
+                np.stack([days[y] for y in years], axis=1),
+                np.nan
+            )
+        )
+    return out
+
+
+def daily_extremes(model, expt, thresholds=None, regrid=False, min_days=360):
+    """
+    Annual TXx/TNn for one model and experiment, in the layout returned by
+    ext_freq.select_extreme_month: a 'tas' variable with dims (extrema, year, lat, lon),
+    where 'heat' is the annual maximum of tasmax and 'cold' the annual minimum of
+    tasmin. Day counts beyond thresholds={'heat_thresholds': ..., 'cold_thresholds': ...},
+    e.g. the output of daily_thresholds, are added as 'exceed_days'.
+    """
+    thresholds = thresholds or {}
+    unknown = set(thresholds) - set(threshold_keys.values())
+    if unknown:
+        raise ValueError(
+            f"Unknown threshold keys {sorted(unknown)}, expected {sorted(threshold_keys.values())}"
+        )
+    dss = []
+    for ext_type in ext_types:
+        var = daily_vars[ext_type]
+        paths = daily_files(model, expt, var, regridded=not regrid)
+        if not paths:
+            raise FileNotFoundError(f"No daily {var} files for {model} {expt}")
+        weights = None
+        if regrid:
+            with xr.open_dataset(paths[0]) as ds:
+                weights = rg.get_weights(ds, model)
+        dss.append(annual_reduce(
+            paths, var, ext_type, thresholds.get(threshold_keys[ext_type]), weights, min_days
+        ))
+    ds = xr.concat(dss, dim='extrema', coords='minimal', compat='override')
+    return ds.assign_coords(extrema=ext_types).rename({'block': 'tas'})
+
+
+def _run(model, expt, thresholds, regrid, min_days, save_dir):
+    ds = daily_extremes(model, expt, thresholds, regrid, min_days)
+    os.makedirs(save_dir, exist_ok=True)
+    path = os.path.join(save_dir, f"{model}_{expt}_daily_extremes.nc")
+    ds.to_netcdf(path)
+    return path
+
+
+def run_daily(
+    model_list=None,
+    expt_list=None,
+    processes=None,
+    thresholds=None,
+    regrid=False,
+    min_days=360,
+    save_dir=daily_dir,
+):
+    """
+    Streams the daily files of every model and experiment through daily_extremes in
+    parallel worker processes and saves the compact annual products to data/processed/daily
+    """
+    model_list = models if model_list is None else model_list
+    expt_list = expts if expt_list is None else expt_list
+    with ProcessPoolExecutor(processes) as pool:
+        jobs = [
+            pool.submit(_run, model, expt, thresholds, regrid, min_days, save_dir)
+            for model in model_list
+            for expt in expt_list
+        ]
+        return [job.result() for job in jobs]
+
+
+def concat_annual_branches(ds_up, ds_down):
+    """
+    Annual equivalent of utils.concat_branches: the first 140 years of 1pctCO2
+    followed by 1pctCO2-cdr, numbered from year 0 so GWL crossing years apply directly
+    """
+    ds_up = ds_up.isel(year=slice(None, 140))
+    ds_up = ds_up.assign_coords(year=np.arange(ds_up.sizes['year']))
+    ds_down = ds_down.assign_coords(year=140 + np.arange(ds_down.sizes['year']))
+    return xr.concat([ds_up, ds_down], dim='year')
+
+
+def daily_thresholds(pi_ds):
+    """
+    Sigma thresholds for TXx/TNn from the piControl annual extremes, as returned by
+    load_data.load_threshold_data for the monthly analysis
+    """
+    heat = pi_ds.tas.sel(extrema='heat', drop=True)
+    cold = pi_ds.tas.sel(extrema='cold', drop=True)
+    return {
+        'heat_thresholds': ext_freq.heat_extreme_thresholds(heat.mean(dim='year'), heat.std(dim='year')),
+        'cold_thresholds': ext_freq.cold_extreme_thresholds(cold.mean(dim='year'), cold.std(dim='year')),
+    }
@@ -2,17 +2,27 @@ import xarray as xr
 import numpy as np
 import cftime
 
+from cdrmip_extremes.time_index import month_mask, monthly_mean, annual_mean, split_static, merge_static
+from cdrmip_extremes import kernels
+
 
 def monthly_extrema(da):
     """
     Returns the months of maximum and minimum temperature for each grid cell
     """
-    grouped = da.groupby('time.month').mean(dim='time')
+    return kernels.dispatch(
+        kernels.monthly_extrema, _monthly_extrema, da, check=kernels.check_extrema
+    )
+
+def _monthly_extrema(da):
+    # variables without a time dimension (e.g. lat_bnds) are passed through unchanged
+    da, static = split_static(da)
+    grouped = monthly_mean(da)
     extrema = xr.concat(
         [grouped.idxmax(dim='month'), grouped.idxmin(dim='month')],
         dim='extrema'
     ).assign_coords({'extrema':['max','min']}).rename({'tas':'month'})
-    return extrema
+    return merge_static(extrema, static)
 
 def monthly_extrema_dt(ds:xr.Dataset) -> xr.Dataset:
     if 'tas' in ds:
@@ -21,14 +31,18 @@ def monthly_extrema_dt(ds:xr.Dataset) -> xr.Dataset:
         return ds
 
 def select_extreme_month(ds,ext_months):
+    return kernels.dispatch(kernels.select_extreme_month, _select_extreme_month, ds, ext_months)
+
+def _select_extreme_month(ds,ext_months):
+    ds, static = split_static(ds)
     dss = []
     for ext_type in ['heat','cold']:
         dss.append(
-            ds.where(
-                ds.time.dt.month==ext_months.sel(extrema=ext_type).month
-            ).groupby('time.year').mean(dim='time')
+            annual_mean(ds.where(
+                month_mask(ds,ext_months.sel(extrema=ext_type).month)
+            ))
         )
-    return xr.concat(dss,dim='extrema')
+    return merge_static(xr.concat(dss,dim='extrema'), static)
     
 
 def extreme_month_means(months,ds):
@@ -36,21 +50,25 @@ def extreme_month_means(months,ds):
     Returns gridded xarray specifying mean tas values for the months specified in 
     'months' - will be either the month of maximum or minimum temperature for each grid cell
     """
-    return ds.where(ds.time.dt.month==months).mean(dim='time')
+    return ds.where(month_mask(ds,months)).mean(dim='time')
 
 def extreme_month_std_dev(months,ds):
     """
     Returns gridded xarray specifying standard deviation in tas values for the months specified in 
     'months' - will be either the month of maximum or minimum temperature for each grid cell
     """
-    return ds.where(ds.time.dt.month==months).std(dim='time')
+    return ds.where(month_mask(ds,months)).std(dim='time')
 
 def extreme_month_stat(ds,months,stat):
-    ds_month = ds.where(ds.time.dt.month==months)
+    return kernels.dispatch(kernels.extreme_month_stat, _extreme_month_stat, ds, months, stat)
+
+def _extreme_month_stat(ds,months,stat):
+    ds, static = split_static(ds)
+    ds_month = ds.where(month_mask(ds,months))
     if stat == 'mean':
-        return ds_month.mean(dim='time')
+        return merge_static(ds_month.mean(dim='time'), static)
     elif stat == 'std':
-        return ds_month.std(dim='time')
+        return merge_static(ds_month.std(dim='time'), static)
     else:
         raise ValueError("stat must be 'mean' or 'std'")
     
@@ -93,6 +111,12 @@ def cold_extreme_thresholds(min_mon_means, std_devs):
 
 
 def calculate_exceedances(monthly_temps,ext_thresholds,ext_type):
+    return kernels.dispatch(
+        kernels.calculate_exceedances, _calculate_exceedances,
+        monthly_temps, ext_thresholds, ext_type
+    )
+
+def _calculate_exceedances(monthly_temps,ext_thresholds,ext_type):
 
     years =monthly_temps.count(dim='year').mean().values
     
@@ -125,6 +149,99 @@ def calculate_exceedances(monthly_temps,ext_thresholds,ext_type):
     return exceedance_frequencies
 
 
+def sigma_thresholds(means, std_devs, multipliers, ext_type):
+    """
+    Thresholds at an arbitrary vector of sigma multipliers, stacked along a new
+    'threshold' dimension. Heat thresholds lie above the mean and cold thresholds
+    below it, so heat_extreme_thresholds corresponds to multipliers [1, 2, 3] and
+    cold_extreme_thresholds to [0.25, 0.5, 1]. Multipliers are applied as Python
+    scalars, as in those functions, so float32 inputs give float32 thresholds
+    identical to theirs.
+    """
+    sign = 1 if ext_type == 'heat' else -1
+    return xr.concat(
+        [means + (sign * float(m)) * std_devs for m in multipliers],
+        dim='threshold'
+    ).assign_coords(threshold=np.asarray(multipliers, dtype=float))
+
+def percentile_thresholds(pi_temps, percentiles, dim='year'):
+    """
+    Empirical thresholds taken as per-cell percentiles of the piControl extreme-month
+    values, stacked along a new 'threshold' dimension
+    """
+    return pi_temps.quantile(
+        np.asarray(percentiles, dtype=float) / 100, dim=dim
+    ).rename({'quantile':'threshold'}).assign_coords(threshold=np.asarray(percentiles, dtype=float))
+
+def _exceedance_counts(values, thresholds, ext_type):
+    """
+    Counts, for every cell, the values above (heat) or below (cold) each threshold.
+    values has shape (..., n) and thresholds (..., k). Each cell is sorted once and
+    offset into its own band of a single sorted vector, so all cells and
+    thresholds are resolved by one searchsorted call.
+    """
+    lead = values.shape[:-1]
+    n = values.shape[-1]
+    ordered = np.sort(values, axis=-1)
+    valid = np.isfinite(ordered)
+    n_valid = valid.sum(axis=-1)[..., None]
+    if not valid.any():
+        return np.full(lead + thresholds.shape[-1:], np.nan)
+
+    lo, hi = np.nanmin(ordered), np.nanmax(ordered)
+    span = hi - lo + 2
+    band = np.arange(int(np.prod(lead))).reshape(lead + (1,))
+
+    # missing values are placed at the top of their cell's band
+    flat = (np.where(valid, ordered, hi + 1) - lo + band * span).ravel()
+    thr = np.clip(thresholds, lo - 0.5, hi + 0.5) - lo + band * span
+
+    side = 'right' if ext_type == 'heat' else 'left'
+    idx = np.searchsorted(flat, np.nan_to_num(thr).ravel(), side=side).reshape(thr.shape) - band * n
+    counts = n_valid - idx if ext_type == 'heat' else idx
+    return np.where(np.isnan(thresholds), np.nan, counts)
+
+def exceedance_curves(monthly_temps, thresholds, ext_type, dim='year'):
+    """
+    Exceedance frequency (% of years) against threshold for every cell, GWL and branch.
+
+    Inputs:
+    monthly_temps: extreme-month temperatures as passed to calculate_exceedances
+    thresholds: thresholds with a 'threshold' dimension, from sigma_thresholds or percentile_thresholds
+    ext_type: 'heat' (values above threshold) or 'cold' (values below threshold)
+    Outputs:
+    DataArray of exceedance frequencies with a trailing 'threshold' dimension. At the
+    standard multipliers this matches the sigma1/2/3 output of calculate_exceedances
+    wherever the threshold is defined; cells with a missing threshold are NaN.
+    """
+    if ext_type not in ('heat', 'cold'):
+        raise ValueError("ext_type must be 'heat' or 'cold'")
+    years = monthly_temps.count(dim=dim).mean().values
+    if 'extrema' in monthly_temps.dims:
+        monthly_temps = monthly_temps.sel(extrema=ext_type)
+    if 'extrema' in thresholds.dims:
+        thresholds = thresholds.sel(extrema=ext_type)
+
+    counts = xr.apply_ufunc(
+        _exceedance_counts,
+        monthly_temps,
+        thresholds,
+        kwargs={'ext_type': ext_type},
+        input_core_dims=[[dim], ['threshold']],
+        output_core_dims=[['threshold']],
+        dask='parallelized',
+        output_dtypes=[float],
+    )
+    return ((counts / years) * 100).rename('frequency')
+
+def sweep_exceedances(monthly_temps, means, std_devs, multipliers, ext_type):
+    """
+    Exceedance frequencies for an arbitrary vector of sigma multipliers in a single call
+    """
+    thresholds = sigma_thresholds(means, std_devs, multipliers, ext_type)
+    return exceedance_curves(monthly_temps, thresholds, ext_type)
+
+
 def calc_agreement(differences):
     differences_all = xr.concat(
         list(differences.values()),
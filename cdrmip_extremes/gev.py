@@ -0,0 +1,293 @@
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+from scipy.special import gamma
+
+# GEV parameters, with the shape following the sign convention of scipy.stats.genextreme
+# (shape > 0 bounded above, as is typical for temperature maxima)
+params = ['loc', 'scale', 'shape']
+
+
+def _sign(ext_type):
+    # minima are fitted as maxima of the negated series
+    if ext_type not in ('heat', 'cold'):
+        raise ValueError("ext_type must be 'heat' or 'cold'")
+    return 1 if ext_type == 'heat' else -1
+
+
+def _lmoment_fit(x, min_years=10):
+    """
+    Probability-weighted-moment (L-moment) estimates of the GEV parameters for
+    every series along the last axis of x at once, using Hosking's (1985)
+    approximation for the shape. Missing values are ignored per series, and
+    series with fewer than min_years values are returned as NaN.
+    """
+    ordered = np.sort(x, axis=-1)
+    valid = np.isfinite(ordered)
+    n = valid.sum(axis=-1, keepdims=True).astype(float)
+    rank = np.arange(x.shape[-1], dtype=float)
+    values = np.where(valid, ordered, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        b0 = values.sum(axis=-1, keepdims=True) / n
+        b1 = (values * rank / (n - 1)).sum(axis=-1, keepdims=True) / n
+        b2 = (values * rank * (rank - 1) / ((n - 1) * (n - 2))).sum(axis=-1, keepdims=True) / n
+        l1 = b0[..., 0]
+        l2 = (2 * b1 - b0)[..., 0]
+        t3 = (6 * b2 - 6 * b1 + b0)[..., 0] / l2
+
+        c = 2 / (3 + t3) - np.log(2) / np.log(3)
+        shape = 7.8590 * c + 2.9554 * c ** 2
+        gumbel = np.abs(shape) < 1e-6
+        k = np.where(gumbel, 1, shape)
+        scale = np.where(gumbel, l2 / np.log(2), l2 * k / ((1 - 2 ** -k) * gamma(1 + k)))
+        loc = np.where(gumbel, l1 - np.euler_gamma * scale, l1 - scale * (1 - gamma(1 + k)) / k)
+
+    out = np.stack([loc, scale, np.where(gumbel, 0, shape)], axis=-1)
+    out[(n[..., 0] < min_years) | ~(l2 > 0)] = np.nan
+    return out
+
+
+def _feasible(x, fitted, margin=0.9):
+    """
+    Shrinks the shape of any fit whose support excludes some of its own
+    observations, which the L-moment estimates of short samples can do, until
+    the most extreme observation lies a margin inside the bound. The likelihood
+    and the return periods of the observed values are then finite.
+    """
+    valid = np.isfinite(x)
+    loc, scale, shape = fitted[..., 0], fitted[..., 1], fitted[..., 2]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        top = np.where(valid, x, -np.inf).max(axis=-1) - loc
+        bottom = np.where(valid, x, np.inf).min(axis=-1) - loc
+        # largest value of shape * (x - loc) / scale, which must stay below 1
+        reach = np.where(shape > 0, shape * top, shape * bottom) / scale
+        out = fitted.copy()
+        out[..., 2] = np.where(reach >= 1, shape * margin / reach, shape)
+    return out
+
+
+def _nll(p, x, valid, max_shape):
+    """
+    Negative log-likelihood of each series for parameters (loc, log scale, shape)
+    """
+    loc, log_scale, shape = p[..., 0:1], p[..., 1:2], p[..., 2:3]
+    y = (x - loc) / np.exp(log_scale)
+    gumbel = np.abs(shape) < 1e-6
+    k = np.where(gumbel, 1, shape)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        log_t = np.log(1 - k * y)
+        logpdf = np.where(
+            gumbel,
+            -log_scale - y - np.exp(-y),
+            -log_scale + (1 / k - 1) * log_t - np.exp(log_t / k)
+        )
+    logpdf = np.where(valid, logpdf, 0)
+    nll = -logpdf.sum(axis=-1)
+    # outside the support of the distribution, or beyond the allowed shape
+    nll[~np.isfinite(nll) | (np.abs(p[..., 2]) > max_shape)] = np.inf
+    return nll
+
+
+def _mle_refine(x, start, n_iter=30, max_shape=0.5, tol=1e-6):
+    """
+    Refines the L-moment estimates towards the maximum-likelihood estimates with
+    a Levenberg-Marquardt iteration run on all series simultaneously. Gradients
+    and Hessians are taken by central differences, and steps that do not reduce
+    a series' negative log-likelihood are rejected with increased damping. Series
+    drop out of the iteration once they have converged. The shape is limited to
+    |shape| <= max_shape, where the MLE is well behaved for short samples.
+    """
+    lead = x.shape[:-1]
+    x = x.reshape(-1, x.shape[-1])
+    start = start.reshape(-1, 3)
+    valid = np.isfinite(x)
+    p = np.stack([start[:, 0], np.log(start[:, 1]), start[:, 2]], axis=-1)
+    fitted = np.isfinite(p).all(axis=-1)
+    p[~fitted] = 0
+    p[:, 2] = np.clip(p[:, 2], -max_shape, max_shape)
+
+    f = _nll(p, x, valid, max_shape)
+    fitted &= np.isfinite(f)
+    damping = np.full(f.shape, 1e-2)
+    eye = np.eye(3)
+    active = fitted.copy()
+
+    for _ in range(n_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        xa, va, pa, fa = x[idx], valid[idx], p[idx], f[idx]
+        h = np.stack(
+            [1e-3 * np.exp(pa[:, 1]), np.full(len(idx), 1e-3), np.full(len(idx), 1e-3)],
+            axis=-1
+        )
+
+        def shifted(*steps):
+            q = pa.copy()
+            for i, sign in steps:
+                q[:, i] += sign * h[:, i]
+            return _nll(q, xa, va, max_shape)
+
+        # near the edge of the support a finite difference can be infinite
+        with np.errstate(invalid='ignore', over='ignore'):
+            plus = [shifted((i, 1)) for i in range(3)]
+            minus = [shifted((i, -1)) for i in range(3)]
+            grad = np.stack([(plus[i] - minus[i]) / (2 * h[:, i]) for i in range(3)], axis=-1)
+            hess = np.zeros((len(idx), 3, 3))
+            for i in range(3):
+                hess[:, i, i] = (plus[i] - 2 * fa + minus[i]) / h[:, i] ** 2
+                for j in range(i + 1, 3):
+                    hess[:, i, j] = hess[:, j, i] = (
+                        shifted((i, 1), (j, 1)) - shifted((i, 1), (j, -1))
+                        - shifted((i, -1), (j, 1)) + shifted((i, -1), (j, -1))
+                    ) / (4 * h[:, i] * h[:, j])
+
+        usable = np.isfinite(grad).all(axis=-1) & np.isfinite(hess).all(axis=(-2, -1))
+        grad = np.where(usable[:, None], grad, 0)
+        hess = np.where(usable[:, None, None], hess, eye)
+        diag = np.abs(np.diagonal(hess, axis1=-2, axis2=-1)) + 1e-12
+        system = hess + damping[idx, None, None] * diag[:, None, :] * eye
+        trial = pa - np.einsum('...ij,...j->...i', np.linalg.pinv(system), grad)
+
+        f_trial = _nll(trial, xa, va, max_shape)
+        accept = usable & (f_trial < fa)
+        p[idx] = np.where(accept[:, None], trial, pa)
+        f[idx] = np.where(accept, f_trial, fa)
+        damping[idx] = np.where(accept, damping[idx] / 10, damping[idx] * 10)
+        active[idx] = ~(accept & (fa - f_trial < tol)) & usable & (damping[idx] < 1e8)
+
+    out = np.stack([p[:, 0], np.exp(p[:, 1]), p[:, 2]], axis=-1)
+    # keep the L-moment estimates wherever the likelihood could not be evaluated
+    out = np.where(fitted[:, None], out, start)
+    return out.reshape(lead + (3,))
+
+
+def _fit(x, method='lmom', min_years=10, n_iter=30, max_shape=0.5):
+    x = np.asarray(x, dtype=float)
+    fitted = _feasible(x, _lmoment_fit(x, min_years))
+    if method == 'mle':
+        fitted = _mle_refine(x, fitted, n_iter, max_shape)
+    return fitted
+
+
+def _fit_pool(x, processes, **kwargs):
+    """
+    Splits the series of x across a process pool
+    """
+    flat = np.asarray(x, dtype=float).reshape(-1, x.shape[-1])
+    chunks = np.array_split(flat, max(1, min(len(flat), 4 * processes)))
+    with ProcessPoolExecutor(processes) as pool:
+        fitted = list(pool.map(functools.partial(_fit, **kwargs), chunks))
+    return np.concatenate(fitted).reshape(x.shape[:-1] + (3,))
+
+
+def fit_gev(da, ext_type, dim='year', method='lmom', processes=None, min_years=10, n_iter=30, max_shape=0.5):
+    """
+    Fits a generalized extreme value distribution to the series along dim of every
+    cell (and GWL, branch, ...) at once.
+
+    Inputs:
+    da: extreme-month temperatures, e.g. from select_extreme_month or extract_gwl_period
+    ext_type: 'heat' fits the maxima directly, 'cold' fits the minima as negated maxima
+    method: 'lmom' for probability-weighted-moment estimates, 'mle' to refine them by maximum likelihood
+    processes: if given, the fits are spread over a process pool; dask-backed
+    inputs are instead fitted chunk by chunk
+    Outputs:
+    Dataset of loc, scale and shape for the distribution of sign * da, where sign is
+    -1 for cold extremes
+    """
+    if method not in ('lmom', 'mle'):
+        raise ValueError("method must be 'lmom' or 'mle'")
+    if 'extrema' in da.dims:
+        da = da.sel(extrema=ext_type)
+    if da.chunks is not None:
+        da = da.chunk({dim: -1})
+    kwargs = {'method': method, 'min_years': min_years, 'n_iter': n_iter, 'max_shape': max_shape}
+    func = _fit if processes is None else functools.partial(_fit_pool, processes=processes)
+
+    fitted = xr.apply_ufunc(
+        func,
+        _sign(ext_type) * da,
+        kwargs=kwargs,
+        input_core_dims=[[dim]],
+        output_core_dims=[['param']],
+        dask='parallelized',
+        output_dtypes=[float],
+        dask_gufunc_kwargs={'output_sizes': {'param': 3}},
+    )
+    return fitted.assign_coords(param=params).to_dataset(dim='param')
+
+
+def _reduced_level(z, shape):
+    gumbel = np.abs(shape) < 1e-6
+    k = xr.where(gumbel, 1, shape)
+    return xr.where(gumbel, -np.log(z), (1 - z ** k) / k)
+
+
+def return_levels(fit, return_periods, ext_type):
+    """
+    Temperature exceeded (heat) or undercut (cold) on average once every T years,
+    for each T in return_periods, stacked along a 'return_period' dimension
+    """
+    T = xr.DataArray(np.asarray(return_periods, dtype=float), dims='return_period')
+    z = -np.log1p(-1 / T)
+    level = fit['loc'] + fit['scale'] * _reduced_level(z, fit['shape'])
+    return (_sign(ext_type) * level).assign_coords(return_period=T.values)
+
+
+def return_periods(fit, values, ext_type):
+    """
+    Average number of years between exceedances (heat) or undercuts (cold) of
+    values under the fitted distribution. Values beyond the bounded tail of the
+    distribution have an infinite return period.
+    """
+    y = (_sign(ext_type) * values - fit['loc']) / fit['scale']
+    shape = fit['shape']
+    gumbel = np.abs(shape) < 1e-6
+    k = xr.where(gumbel, 1, shape)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        s = xr.where(gumbel, np.exp(-y), np.maximum(1 - k * y, 0) ** (1 / k))
+        return 1 / -np.expm1(-s)
+
+
+def baseline_return_periods(
+    monthly_temps, pi_temps, ext_type, periods=(10, 20, 50), dim='year', **fit_kwargs
+):
+    """
+    Compares the GEV fitted in each GWL period with the piControl baseline used by
+    the threshold functions.
+
+    Inputs:
+    monthly_temps: extreme-month temperatures for the periods of interest, e.g.
+    from extract_gwl_period, as passed to calculate_exceedances
+    pi_temps: piControl extreme-month temperatures, from select_extreme_month
+    periods: return periods (years) of the piControl events
+    Outputs:
+    Dataset with, for each return period T:
+    baseline_level: the piControl 1-in-T-year temperature
+    return_level: the 1-in-T-year temperature in each period
+    baseline_return_period: how often the piControl 1-in-T-year event recurs in each period
+    """
+    pi_fit = fit_gev(pi_temps, ext_type, dim=dim, **fit_kwargs)
+    fit = fit_gev(monthly_temps, ext_type, dim=dim, **fit_kwargs)
+    baseline = return_levels(pi_fit, periods, ext_type)
+    return xr.Dataset({
+        'baseline_level': baseline,
+        'return_level': return_levels(fit, periods, ext_type),
+        'baseline_return_period': return_periods(fit, baseline, ext_type),
+    })
+
+
+def threshold_return_periods(fit, ext_thresholds, ext_type):
+    """
+    Return periods of the sigma thresholds from heat_extreme_thresholds or
+    cold_extreme_thresholds under a fitted distribution, as sigma1, sigma2 and sigma3
+    (the fitted counterpart of 100 / the frequencies from calculate_exceedances)
+    """
+    return xr.merge([
+        return_periods(fit, ext_thresholds[f"threshold{i}"], ext_type).rename(f"sigma{i}")
+        for i in (1, 2, 3)
+    ])
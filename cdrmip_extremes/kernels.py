@@ -0,0 +1,378 @@
+import functools
+import importlib.util
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import xarray as xr
+
+from cdrmip_extremes.time_index import (
+    add_calendar_coords, drop_calendar_coords, monthly_mean, split_static, merge_static,
+    year_coord, month_coord
+)
+
+_backend = {'name': 'numpy', 'verify': False}
+
+
+def numba_available():
+    return importlib.util.find_spec('numba') is not None
+
+
+def set_backend(name, verify=False):
+    """
+    Selects the implementation used for the per-cell kernels in ext_freq and sat.
+
+    Inputs:
+    name: 'numba' for the JIT-compiled parallel kernels, 'numpy' for the xarray path
+    verify: if True, every numba call is also run through the xarray path and the
+    results compared, raising an AssertionError on any difference
+    """
+    if name not in ('numba', 'numpy'):
+        raise ValueError("backend must be 'numba' or 'numpy'")
+    if name == 'numba' and not numba_available():
+        warnings.warn("numba is not installed, falling back to the numpy backend")
+        name = 'numpy'
+    _backend['name'] = name
+    _backend['verify'] = verify
+
+
+def get_backend():
+    return _backend['name']
+
+
+def check_equal(result, reference, rtol=1e-5):
+    if isinstance(reference, (xr.DataArray, xr.Dataset)):
+        xr.testing.assert_allclose(result, reference, rtol=rtol)
+    elif result != reference:
+        raise AssertionError(f"numba result {result} != reference {reference}")
+
+
+def check_extrema(result, reference, ds, rtol=1e-5):
+    """
+    The kernels accumulate monthly means in float64, so with float32 input the
+    month of maximum or minimum can legitimately differ where two monthly means
+    are tied to within float32 precision. Such cells are accepted if the monthly
+    means of both months agree.
+    """
+    differs = (result.month != reference.month) & reference.month.notnull()
+    if not differs.any():
+        return check_equal(result, reference, rtol)
+    timed, _ = split_static(ds)
+    means = monthly_mean(timed)
+    if isinstance(means, xr.Dataset):
+        means = means[next(iter(timed.data_vars))]
+    def at(months):
+        idx = months.where(differs, 1).fillna(1).astype(int)
+        return means.sel(month=idx).drop_vars('month').where(differs)
+    xr.testing.assert_allclose(at(result.month), at(reference.month), rtol=rtol)
+    check_equal(result.where(~differs), reference.where(~differs), rtol)
+
+
+def dispatch(fast, reference, *args, check=None, **kwargs):
+    """
+    Calls fast(*args) under the numba backend and reference(*args) otherwise
+    """
+    if _backend['name'] != 'numba':
+        return reference(*args, **kwargs)
+    result = fast(*args, **kwargs)
+    if _backend['verify']:
+        reference = reference(*args, **kwargs)
+        if check is None:
+            check_equal(result, reference)
+        else:
+            check(result, reference, *args)
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _jit():
+    """
+    Compiles the kernels on first use, so importing the package never pays for
+    numba's import or compilation
+    """
+    import numba
+
+    @numba.njit(parallel=True, cache=True)
+    def monthly_extrema(x, month):
+        # x (cell, time), month (time,) in 1..12 -> (cell, 2) months of max/min mean
+        n, t = x.shape
+        out = np.full((n, 2), np.nan)
+        for c in numba.prange(n):
+            sums = np.zeros(12)
+            counts = np.zeros(12)
+            for i in range(t):
+                v = x[c, i]
+                if not np.isnan(v):
+                    sums[month[i] - 1] += v
+                    counts[month[i] - 1] += 1
+            best_max = -np.inf
+            best_min = np.inf
+            for m in range(12):
+                if counts[m] > 0:
+                    mean = sums[m] / counts[m]
+                    if mean > best_max:
+                        best_max = mean
+                        out[c, 0] = m + 1
+                    if mean < best_min:
+                        best_min = mean
+                        out[c, 1] = m + 1
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def select_month(x, month, year_idx, n_years, ext):
+        # mean of x in month ext[c] for each year -> (cell, year)
+        n, t = x.shape
+        out = np.full((n, n_years), np.nan)
+        for c in numba.prange(n):
+            if np.isnan(ext[c]):
+                continue
+            target = int(ext[c])
+            sums = np.zeros(n_years)
+            counts = np.zeros(n_years)
+            for i in range(t):
+                v = x[c, i]
+                if month[i] == target and not np.isnan(v):
+                    sums[year_idx[i]] += v
+                    counts[year_idx[i]] += 1
+            for y in range(n_years):
+                if counts[y] > 0:
+                    out[c, y] = sums[y] / counts[y]
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def month_stat(x, month, ext, std):
+        # two-pass mean or (ddof=0) standard deviation of x in month ext[c] -> (cell,)
+        n, t = x.shape
+        out = np.full(n, np.nan)
+        for c in numba.prange(n):
+            if np.isnan(ext[c]):
+                continue
+            target = int(ext[c])
+            total = 0.0
+            count = 0
+            for i in range(t):
+                v = x[c, i]
+                if month[i] == target and not np.isnan(v):
+                    total += v
+                    count += 1
+            if count == 0:
+                continue
+            mean = total / count
+            if not std:
+                out[c] = mean
+                continue
+            ss = 0.0
+            for i in range(t):
+                v = x[c, i]
+                if month[i] == target and not np.isnan(v):
+                    ss += (v - mean) ** 2
+            out[c] = np.sqrt(ss / count)
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def count_exceedances(x, thresholds, heat):
+        # x (cell, year), thresholds (cell, k) -> (cell, k) counts of years beyond each threshold
+        n, y = x.shape
+        k = thresholds.shape[1]
+        out = np.zeros((n, k))
+        for c in numba.prange(n):
+            for j in range(k):
+                thr = thresholds[c, j]
+                count = 0
+                for i in range(y):
+                    if heat:
+                        if x[c, i] > thr:
+                            count += 1
+                    elif x[c, i] < thr:
+                        count += 1
+                out[c, j] = count
+        return out
+
+    @numba.njit(cache=True)
+    def first_crossing(values, gwl, above):
+        for i in range(values.shape[0]):
+            if above and values[i] >= gwl:
+                return i
+            if not above and values[i] <= gwl:
+                return i
+        return -1
+
+    return SimpleNamespace(
+        monthly_extrema=monthly_extrema,
+        select_month=select_month,
+        month_stat=month_stat,
+        count_exceedances=count_exceedances,
+        first_crossing=first_crossing,
+    )
+
+
+def _cells(x):
+    return np.ascontiguousarray(x.reshape(-1, x.shape[-1]), dtype=np.float64)
+
+
+def _out_dtype(x):
+    # the kernels work in float64; results are returned in the input's precision
+    # as on the xarray path
+    return x.dtype if np.issubdtype(x.dtype, np.floating) else np.dtype(np.float64)
+
+
+def _dtype_of(ds):
+    da = ds if isinstance(ds, xr.DataArray) else next(iter(ds.data_vars.values()))
+    return _out_dtype(da)
+
+
+def _split_time(ds):
+    """
+    Returns the variables along time, rechunked to a single time chunk if
+    dask-backed since the kernels need whole series, and the time-invariant
+    variables (e.g. lat_bnds), which are passed through unchanged
+    """
+    ds, static = split_static(ds)
+    if ds.chunks:
+        ds = ds.chunk({'time': -1})
+    return add_calendar_coords(ds), static
+
+
+def monthly_extrema(ds):
+    ds, static = _split_time(ds)
+    month = ds[month_coord].values.astype(np.int64)
+    k = _jit()
+
+    def kernel(x):
+        return k.monthly_extrema(_cells(x), month).reshape(x.shape[:-1] + (2,))
+
+    extrema = xr.apply_ufunc(
+        kernel,
+        drop_calendar_coords(ds),
+        input_core_dims=[['time']],
+        output_core_dims=[['extrema']],
+        dask='parallelized',
+        output_dtypes=[float],
+        dask_gufunc_kwargs={'output_sizes': {'extrema': 2}},
+    )
+    extrema = extrema.transpose('extrema', ...).assign_coords({'extrema': ['max', 'min']})
+    return merge_static(extrema.rename({'tas': 'month'}), static)
+
+
+def _select_month(ds, ext_month):
+    years, year_idx = np.unique(ds[year_coord].values, return_inverse=True)
+    month = ds[month_coord].values.astype(np.int64)
+    k = _jit()
+
+    def kernel(x, ext):
+        ext = np.broadcast_to(ext, x.shape[:-1]).ravel().astype(np.float64)
+        out = k.select_month(_cells(x), month, year_idx, len(years), ext)
+        return out.reshape(x.shape[:-1] + (len(years),)).astype(_out_dtype(x), copy=False)
+
+    out = xr.apply_ufunc(
+        kernel,
+        drop_calendar_coords(ds),
+        ext_month,
+        input_core_dims=[['time'], []],
+        output_core_dims=[['year']],
+        dask='parallelized',
+        output_dtypes=[_dtype_of(ds)],
+        dask_gufunc_kwargs={'output_sizes': {'year': len(years)}},
+    )
+    return out.assign_coords(year=years).transpose('year', ...)
+
+
+def select_extreme_month(ds, ext_months):
+    ds, static = _split_time(ds)
+    return merge_static(xr.concat(
+        [_select_month(ds, ext_months.sel(extrema=ext_type).month) for ext_type in ['heat', 'cold']],
+        dim='extrema'
+    ), static)
+
+
+def extreme_month_stat(ds, months, stat):
+    if stat not in ('mean', 'std'):
+        raise ValueError("stat must be 'mean' or 'std'")
+    ds, static = _split_time(ds)
+    month = ds[month_coord].values.astype(np.int64)
+    k = _jit()
+
+    def kernel(x, ext):
+        ext = np.broadcast_to(ext, x.shape[:-1]).ravel().astype(np.float64)
+        out = k.month_stat(_cells(x), month, ext, stat == 'std').reshape(x.shape[:-1])
+        return out.astype(_out_dtype(x), copy=False)
+
+    return merge_static(xr.apply_ufunc(
+        kernel,
+        drop_calendar_coords(ds),
+        months,
+        input_core_dims=[['time'], []],
+        dask='parallelized',
+        output_dtypes=[_dtype_of(ds)],
+    ), static)
+
+
+def calculate_exceedances(monthly_temps, ext_thresholds, ext_type):
+    years = monthly_temps.count(dim='year').mean().values
+    monthly_temps = monthly_temps.sel(extrema=ext_type)
+    thresholds = xr.concat(
+        [ext_thresholds[f"threshold{i}"] for i in (1, 2, 3)],
+        dim='threshold'
+    ).reset_coords(drop=True)
+    k = _jit()
+
+    def kernel(x, thr):
+        thr = np.broadcast_to(thr, x.shape[:-1] + thr.shape[-1:])
+        thr = np.ascontiguousarray(thr.reshape(-1, thr.shape[-1]), dtype=np.float64)
+        out = k.count_exceedances(_cells(x), thr, ext_type == 'heat')
+        return out.reshape(x.shape[:-1] + (3,))
+
+    counts = xr.apply_ufunc(
+        kernel,
+        monthly_temps,
+        thresholds,
+        input_core_dims=[['year'], ['threshold']],
+        output_core_dims=[['threshold']],
+        dask='parallelized',
+        output_dtypes=[float],
+    )
+    frequencies = (counts / years) * 100
+    return xr.merge([
+        frequencies.isel(threshold=i, drop=True).rename(f"sigma{i + 1}") for i in range(3)
+    ])
+
+
+def first_crossing(da, gwl, above=True):
+    idx = _jit().first_crossing(np.asarray(da.values, dtype=np.float64), float(gwl), above)
+    if idx < 0:
+        raise IndexError(f"Series never {'reaches' if above else 'falls to'} {gwl}")
+    return int(da['year'][idx])
+
+
+def check_backend(n_years=30, shape=(12, 16), seed=0):
+    """
+    Runs the extreme-month kernels in verify mode on a small synthetic float32
+    dataset, which is given a time-invariant lat_bnds variable, both in memory
+    and dask-chunked along time as returned by the regridding loaders. Raises
+    an AssertionError if the numba and xarray paths differ.
+    """
+    from cdrmip_extremes import ext_freq
+
+    rng = np.random.default_rng(seed)
+    n = 12 * n_years
+    time = xr.date_range('0001-01-16', periods=n, freq='MS', calendar='noleap', use_cftime=True)
+    seasonal = 10 * np.sin(2 * np.pi * np.arange(n) / 12)[:, None, None]
+    tas = (280 + seasonal + rng.normal(0, 3, (n,) + shape)).astype(np.float32)
+    ds = xr.Dataset(
+        {
+            'tas': (('time', 'lat', 'lon'), tas),
+            'lat_bnds': (('lat', 'bnds'), np.zeros((shape[0], 2))),
+        },
+        coords={'time': time, 'lat': np.arange(shape[0], dtype=float), 'lon': np.arange(shape[1], dtype=float)}
+    )
+
+    previous = dict(_backend)
+    set_backend('numba', verify=True)
+    try:
+        for case in (ds, ds.chunk({'time': 120})):
+            ext_months = ext_freq.monthly_extrema(case).assign_coords(extrema=['heat', 'cold'])
+            ext_freq.select_extreme_month(case, ext_months).load()
+            for stat in ('mean', 'std'):
+                ext_freq.extreme_month_stat(case, ext_months.sel(extrema='heat').month, stat).load()
+    finally:
+        _backend.update(previous)
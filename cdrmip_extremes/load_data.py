@@ -1,24 +1,113 @@
 import numpy as np
 import xarray as xr
 import os
+import glob
+import functools
 import netCDF4 as nc
 import cftime
 from pathlib import Path
 
 from cdrmip_extremes.configs import data_dir, models, expts
+from cdrmip_extremes import regrid as rg
+from cdrmip_extremes import catalog
+from cdrmip_extremes.time_index import annual_mean
 
+# time chunking used when streaming native-grid files through the regridder
+regrid_chunks = {'time': 120}
 
-def load_raw_tas():
+
+def _native_paths(var_dir, model, expt, name):
+    """
+    Native-grid files of a record in time order: either one merged file
+    <model>_<expt>_<name>.nc or the ESGF time slices <model>_<expt>_<name>_<start>-<end>.nc,
+    excluding any copies already remapped onto the common grid (r180x90)
+    """
+    paths = sorted(glob.glob(os.path.join(var_dir, expt, f"{model}_{expt}_{name}*.nc")))
+    return [path for path in paths if not catalog.is_regridded(path)]
+
+def _dir_paths(record_dir):
+    return sorted(glob.glob(os.path.join(record_dir, '*.nc')))
+
+def _open_native(paths, **kwargs):
+    if not paths:
+        raise FileNotFoundError("No files found for record")
+    if len(paths) == 1:
+        return xr.open_dataset(paths[0], **kwargs)
+    return xr.open_mfdataset(
+        paths,
+        combine='nested',
+        concat_dim='time',
+        data_vars='minimal',
+        coords='minimal',
+        compat='override',
+        join='override',
+        **kwargs
+    )
+
+def _as_dataarray(ds):
+    (name,) = ds.data_vars
+    da = ds[name]
+    return da.rename(None) if name == '__xarray_dataarray_variable__' else da
+
+def _open(path, record=None, dataarray=False, **kwargs):
+    """
+    Opens a file, or with record={model, experiment, variable, regridded} a raw
+    record, through the catalog where it has been built, so multi-file records are
+    combined in time order with the pre-decoded time axis. Falls back to the
+    fixed path if there is no catalog or the file is not catalogued. For a
+    record, path may instead be a function returning the list of files, which
+    is only called on this fallback.
+    """
+    ds = None
+    try:
+        if record is None:
+            ds = catalog.open_path(path, **kwargs)
+        else:
+            ds = catalog.open_dataset(**record, **kwargs)
+    except FileNotFoundError:
+        pass
+    if ds is None:
+        if callable(path):
+            path = path()
+        if isinstance(path, list):
+            ds = _open_native(path, **kwargs)
+        elif dataarray:
+            return xr.open_dataarray(path, **kwargs)
+        else:
+            ds = xr.open_dataset(path, **kwargs)
+    return _as_dataarray(ds) if dataarray else ds
+
+
+def load_raw_tas(regrid=False):
+    """
+    Loads tas for each model and experiment on the common 2º grid. With
+    regrid=True the native-grid files are read instead and conservatively
+    remapped on the fly, so the r180x90 copies do not need to exist. Native
+    records may be a single merged file or the multi-file ESGF time slices.
+    """
     tas_dir = os.path.join(data_dir,'raw/tas')
     data = {model:{} for model in models}
     for model in models:
         for expt in expts:
-            path = os.path.join(
-                tas_dir,
-                expt,
-                f"{model}_{expt}_Amon_tas_r180x90.nc"
-            )
-            data[model][expt] = xr.open_dataset(path,drop_variables=['height','time_bnds'])
+            if regrid:
+                ds = _open(
+                    functools.partial(_native_paths, tas_dir, model, expt, 'Amon_tas'),
+                    dict(model=model, experiment=expt, variable='tas', regridded=False),
+                    drop_variables=['height','time_bnds'],
+                    chunks=regrid_chunks
+                )
+                data[model][expt] = rg.regrid_dataset(ds,model,'tas')
+            else:
+                path = os.path.join(
+                    tas_dir,
+                    expt,
+                    f"{model}_{expt}_Amon_tas_r180x90.nc"
+                )
+                data[model][expt] = _open(
+                    path,
+                    dict(model=model, experiment=expt, variable='tas', regridded=True),
+                    drop_variables=['height','time_bnds']
+                )
     return data
 
 def load_tas_concat():
@@ -30,7 +119,7 @@ def load_tas_concat():
             save_dir,
             f"{model}_cdr-reversibility_tas_concat.nc"
         )
-        data[model] = xr.open_dataset(path)
+        data[model] = _open(path)
     return data
 
 def load_tas_anom():
@@ -41,7 +130,7 @@ def load_tas_anom():
             save_dir,
             f"{model}_cdr-reversibility_tas_anom.nc"
         )
-        data[model] = xr.open_dataset(path)
+        data[model] = _open(path)
     return data
 
 def load_gsat():
@@ -53,7 +142,7 @@ def load_gsat():
             save_dir,
             f"{model}_cdr-reversibility_gsat.nc"
         )
-        gsat[model] = xr.open_dataarray(path)
+        gsat[model] = _open(path,dataarray=True)
     return gsat
 
 def load_sat_difference(period):
@@ -64,7 +153,7 @@ def load_sat_difference(period):
             save_dir,
             f"{model}_{period}_difference.nc"
         )
-        data[model] = xr.open_dataset(path)
+        data[model] = _open(path)
     return data
 
 def load_gwl_years():
@@ -77,12 +166,16 @@ def load_gwl_years():
             save_dir,
             f"{model}_gwl_years.nc"
         )
-        gwl_years[model] = xr.open_dataarray(path)
+        gwl_years[model] = _open(path,dataarray=True)
     return gwl_years
 
 def load_equiv_gwls():
     path = os.path.join(data_dir,"processed/gwl_years/matched_gwls.nc")
-    return xr.open_dataset(path)
+    return _open(path)
+
+def load_co2():
+    path = os.path.join(data_dir,"processed/co2/co2.nc")
+    return _open(path,dataarray=True).rename('CO2')
 
 def load_threshold_data():
     threshold_data = {model:{} for model in models}
@@ -97,7 +190,7 @@ def load_threshold_data():
                 var_dir,
                 f"{model}_{var}.nc"
             )
-            threshold_data[model][var] = xr.open_dataset(path)
+            threshold_data[model][var] = _open(path)
     return threshold_data
 
 def load_monthly_extreme_data(ext_vars=None):
@@ -121,9 +214,9 @@ def load_monthly_extreme_data(ext_vars=None):
                 f"{model}_{var}.nc"
             )
             if var == 'extreme_months':
-                data[model][var] = xr.open_dataset(path)
+                data[model][var] = _open(path)
             else:
-                data[model][var] = xr.open_dataarray(path)
+                data[model][var] = _open(path,dataarray=True)
     return data
 
 def load_ext_freq_data(final=False):
@@ -146,7 +239,7 @@ def load_ext_freq_data(final=False):
                 var_dir,
                 f"median_{var}.nc"
             )
-        data['Multi-Model Median'][var] = xr.open_dataset(path)
+        data['Multi-Model Median'][var] = _open(path)
 
     for model in models:
         for var in ['cold_exceedances','heat_exceedances']:
@@ -162,7 +255,7 @@ def load_ext_freq_data(final=False):
                     var_dir,
                     f"{model}_{var}.nc"
                 )
-            data[model][var] = xr.open_dataset(path)
+            data[model][var] = _open(path)
         
     return data
 
@@ -179,7 +272,7 @@ def load_ext_freq_piControl():
             var_dir,
             f"median_{var}_piControl.nc"
         )
-        data['Multi-Model Median'][var] = xr.open_dataset(path)
+        data['Multi-Model Median'][var] = _open(path)
 
     for model in models:
         for var in ['cold_exceedances','heat_exceedances']:
@@ -188,7 +281,7 @@ def load_ext_freq_piControl():
                 var_dir,
                 f"{model}_{var}_piControl.nc"
             )
-            data[model][var] = xr.open_dataset(path)
+            data[model][var] = _open(path)
         
     return data
 
@@ -209,7 +302,22 @@ def load_ext_month_tas(final=False):
             save_dir,
             f"{model}_extreme_month_tas_{period}.nc"
         )
-        data[model] = xr.open_dataset(path)
+        data[model] = _open(path)
+    return data
+
+def load_daily_extremes():
+    """
+    Loads the annual TXx/TNn products written by daily.run_daily
+    """
+    save_dir = os.path.join(data_dir,'processed/daily')
+    data = {model:{} for model in models}
+    for model in models:
+        for expt in expts:
+            path = os.path.join(
+                save_dir,
+                f"{model}_{expt}_daily_extremes.nc"
+            )
+            data[model][expt] = _open(path)
     return data
 
 def load_amoc():
@@ -218,16 +326,30 @@ def load_amoc():
     for model in models:
         path = os.path.join(amoc_dir,f"{model}_amoc_26N.nc")
         path_pi = os.path.join(amoc_dir,f"{model}_amoc_26N_piControl.nc")
-        amoc = xr.open_dataarray(path).groupby('time.year').mean(dim='time')
-        amoc_piControl = xr.open_dataarray(path_pi).groupby('time.year').mean(dim='time')
+        amoc = annual_mean(_open(path,dataarray=True))
+        amoc_piControl = annual_mean(_open(path_pi,dataarray=True))
         amoc_data[model]['amoc_26N'] = amoc
         amoc_data[model]['amoc_piControl'] = amoc_piControl
         amoc_data[model]['anom'] =  amoc - amoc_piControl.mean(dim='year')
         amoc_data[model]['std_dev'] = amoc_piControl.std(dim='year')
     return amoc_data
 
-def load_mrsos():
-    # load
+def load_msftmz():
+    # multi-file records are assembled from the catalog where it has been built,
+    # otherwise all files in raw/msftmz-msftyz/<expt>/<model> are combined
+    msftmz_dir = os.path.join(data_dir,'raw/msftmz-msftyz')
+    data = {model:{} for model in models}
+    for model in models:
+        for expt in expts:
+            data[model][expt] = _open(
+                functools.partial(_dir_paths, os.path.join(msftmz_dir,expt,model)),
+                dict(model=model, experiment=expt, variable='msftmz-msftyz'),
+                chunks={}
+            )
+    return data
+
+def load_mrsos(regrid=False):
+    # load, optionally remapping from the native grid onto the common 2º grid
     save_dir = os.path.join(data_dir,'raw/mrsos/')
     data = {model:{} for model in models}
     for expt in expts[:2]:
@@ -237,11 +359,19 @@ def load_mrsos():
                 expt_dir,
                 f"{model}_{expt}_mrsos.nc"
             )
-            data[model][expt] = xr.open_dataarray(path)
+            if regrid:
+                ds = _open(
+                    functools.partial(_native_paths,save_dir,model,expt,'mrsos'),
+                    dict(model=model, experiment=expt, variable='mrsos', regridded=False),
+                    chunks=regrid_chunks
+                )
+                data[model][expt] = rg.regrid(ds['mrsos'],rg.get_weights(ds,model))
+            else:
+                data[model][expt] = _open(path,dataarray=True)
     return data
 
-def load_siconc():
-    # load
+def load_siconc(regrid=False):
+    # load, optionally remapping from the native grid onto the common 2º grid
     save_dir = os.path.join(data_dir,'raw/siconc/')
     data = {model:{} for model in models}
     for expt in expts[:2]:
@@ -251,7 +381,15 @@ def load_siconc():
                 expt_dir,
                 f"{model}_{expt}_siconc.nc"
             )
-            data[model][expt] = xr.open_dataarray(path)
+            if regrid:
+                ds = _open(
+                    functools.partial(_native_paths,save_dir,model,expt,'siconc'),
+                    dict(model=model, experiment=expt, variable='siconc', regridded=False),
+                    chunks=regrid_chunks
+                )
+                data[model][expt] = rg.regrid(ds['siconc'],rg.get_weights(ds,model))
+            else:
+                data[model][expt] = _open(path,dataarray=True)
     return data
 
 def load_areacello():
@@ -262,6 +400,6 @@ def load_areacello():
             save_dir,
             f"{model}_areacello.nc"
         )
-        data[model] = xr.open_dataarray(path)
+        data[model] = _open(path,dataarray=True)
     return data
     
\ No newline at end of file
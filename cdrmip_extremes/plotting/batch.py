@@ -0,0 +1,416 @@
+import os
+import functools
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+
+# extent of the common r180x90 grid as passed to imshow throughout the notebooks
+grid_extent = (0, 360, -90, 90)
+
+_batch = {'enabled': False}
+_templates = {}
+_images = weakref.WeakKeyDictionary()
+_coastlines = weakref.WeakSet()
+
+
+def enable_batch():
+    """
+    Switch to headless batch rendering: figures are drawn with the Agg backend
+    and map grids are reused between figures instead of being rebuilt
+    """
+    matplotlib.use('Agg')
+    _batch['enabled'] = True
+
+
+@functools.lru_cache(maxsize=None)
+def warp_indices(projection, shape, extent=grid_extent, regrid_shape=750):
+    """
+    Returns the (row, col) index of the source grid cell underlying each pixel of
+    the projected image, along with a validity mask and the projected extent.
+    Computed once per projection, grid shape and extent, so drawing a panel is
+    reduced to a fancy-indexing operation.
+    """
+    ny_src, nx_src = shape
+    x0, x1 = projection.x_limits
+    y0, y1 = projection.y_limits
+
+    # match cartopy's default of regrid_shape pixels along the shorter side
+    aspect = (x1 - x0) / (y1 - y0)
+    if aspect >= 1:
+        ny, nx = regrid_shape, int(regrid_shape * aspect)
+    else:
+        ny, nx = int(regrid_shape / aspect), regrid_shape
+
+    # pixel centres in projected coordinates
+    xs = x0 + (np.arange(nx) + 0.5) * (x1 - x0) / nx
+    ys = y0 + (np.arange(ny) + 0.5) * (y1 - y0) / ny
+    x, y = np.meshgrid(xs, ys)
+
+    lonlat = ccrs.PlateCarree().transform_points(projection, x, y)
+    lon, lat = lonlat[..., 0], lonlat[..., 1]
+    valid = np.isfinite(lon) & np.isfinite(lat)
+
+    lon0, lon1, lat0, lat1 = extent
+    dlon = (lon1 - lon0) / nx_src
+    dlat = (lat1 - lat0) / ny_src
+    cols = np.floor((np.where(valid, lon, lon0) - lon0) / dlon).astype(int) % nx_src
+    rows = np.clip(
+        np.floor((np.where(valid, lat, lat0) - lat0) / dlat).astype(int),
+        0, ny_src - 1
+    )
+    valid &= (lat >= lat0) & (lat <= lat1)
+
+    return rows, cols, valid, (x0, x1, y0, y1)
+
+
+@functools.lru_cache(maxsize=None)
+def coastline_geometries(projection, resolution='110m'):
+    """
+    Returns the Natural Earth coastlines already projected onto `projection`
+    """
+    src = ccrs.PlateCarree()
+    coast = cfeature.NaturalEarthFeature('physical', 'coastline', resolution)
+    return tuple(
+        projection.project_geometry(geom, src) for geom in coast.geometries()
+    )
+
+
+def warp(data, projection, extent=grid_extent):
+    """
+    Warps a (lat, lon) field with origin='lower' onto `projection` using the
+    cached indices from `warp_indices`
+    """
+    values = np.asarray(data, dtype=float)
+    rows, cols, valid, proj_extent = warp_indices(projection, values.shape, extent)
+    warped = np.full(valid.shape, np.nan)
+    warped[valid] = values[rows[valid], cols[valid]]
+    return np.ma.masked_invalid(warped), proj_extent
+
+
+def draw_map(ax, data, extent=grid_extent, **kwargs):
+    """
+    Drop-in replacement for ax.imshow(data, transform=ccrs.PlateCarree(),
+    origin='lower', extent=extent, ...) on a GeoAxes. The image artist is reused
+    when the axes is drawn on again, which is what a map template relies on.
+    """
+    warped, proj_extent = warp(data, ax.projection, extent)
+    kwargs.pop('transform', None)
+    kwargs.pop('origin', None)
+
+    im = _images.get(ax)
+    if im is None or im.axes is not ax:
+        im = ax.imshow(
+            warped,
+            transform=ax.projection,
+            origin='lower',
+            extent=proj_extent,
+            **kwargs
+        )
+        _images[ax] = im
+    else:
+        norm = kwargs.pop('norm', None)
+        if norm is None:
+            norm = Normalize(kwargs.pop('vmin', None), kwargs.pop('vmax', None))
+        im.set_data(warped)
+        im.set_norm(norm)
+        im.set(visible=True, **kwargs)
+        im.autoscale_None()
+    return im
+
+
+def add_coastlines(ax, **kwargs):
+    """
+    Adds pre-projected coastlines to ax, once per axes
+    """
+    if ax in _coastlines:
+        return
+    kwargs.setdefault('edgecolor', 'black')
+    kwargs.setdefault('facecolor', 'none')
+    ax.add_geometries(coastline_geometries(ax.projection), crs=ax.projection, **kwargs)
+    _coastlines.add(ax)
+
+
+class MapTemplate:
+    """
+    A figure holding a grid of GeoAxes with coastlines attached. In batch mode one
+    template is kept per layout and reset between figures, so only image data,
+    colour scaling and labels change from one figure to the next.
+    """
+
+    def __init__(self, nrows, ncols, figsize, projection=None, **subplot_kw):
+        projection = ccrs.Robinson() if projection is None else projection
+        self.fig, self.axes = plt.subplots(
+            nrows, ncols,
+            subplot_kw={"projection": projection},
+            figsize=figsize,
+            squeeze=False,
+            **subplot_kw
+        )
+        for ax in self.axes.flat:
+            add_coastlines(ax)
+        pars = self.fig.subplotpars
+        self._subplotpars = {
+            name: getattr(pars, name)
+            for name in ['left', 'right', 'bottom', 'top', 'wspace', 'hspace']
+        }
+        self._positions = [ax.get_position(original=True).frozen() for ax in self.axes.flat]
+
+    def reset(self):
+        """
+        Strip everything added on top of the template (colorbars, annotations,
+        titles) and restore the original axes layout
+        """
+        template_axes = set(self.axes.flat)
+        for ax in list(self.fig.axes):
+            if ax not in template_axes:
+                ax.remove()
+        for text in list(self.fig.texts):
+            text.remove()
+        self.fig._suptitle = None
+        self.fig.subplots_adjust(**self._subplotpars)
+        for ax, pos in zip(self.axes.flat, self._positions):
+            for text in list(ax.texts):
+                text.remove()
+            ax.set_title('')
+            ax.set_anchor('C')
+            ax.set_position(pos)
+            im = _images.get(ax)
+            if im is not None:
+                im.set_visible(False)
+
+
+def map_grid(nrows, ncols, figsize, projection=None, **subplot_kw):
+    """
+    Returns (fig, axes) for a grid of map panels. Outside batch mode this is
+    equivalent to plt.subplots with a Robinson projection; in batch mode the
+    grid is taken from a per-layout template.
+    """
+    if not _batch['enabled']:
+        template = MapTemplate(nrows, ncols, figsize, projection, **subplot_kw)
+        return template.fig, template.axes
+
+    projection = ccrs.Robinson() if projection is None else projection
+    key = (nrows, ncols, tuple(figsize), projection, tuple(sorted(subplot_kw.items())))
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = MapTemplate(
+            nrows, ncols, figsize, projection, **subplot_kw
+        )
+    else:
+        template.reset()
+    return template.fig, template.axes
+
+
+def finish(fig, save_path=None, **savefig_kw):
+    """
+    Saves and/or shows a finished figure. Template figures are left open for
+    reuse in batch mode, other figures are closed once saved.
+    """
+    if save_path is not None:
+        savefig_kw.setdefault('bbox_inches', 'tight')
+        fig.savefig(save_path, **savefig_kw)
+    if not _batch['enabled']:
+        if save_path is None:
+            plt.show()
+        return save_path
+    if not any(t.fig is fig for t in _templates.values()):
+        plt.close(fig)
+    return save_path
+
+
+def _render(job):
+    func, args, kwargs = job
+    return func(*args, **kwargs)
+
+
+def render_figures(jobs, processes=None):
+    """
+    Renders independent figures in a process pool.
+
+    Parameters
+    ----------
+    jobs : list of (func, args, kwargs)
+        Module-level plotting functions together with their arguments. Each
+        call is expected to save its own figure, e.g. via a `save_path` kwarg.
+    processes : int, optional
+        Number of worker processes, defaults to os.cpu_count().
+
+    Returns
+    -------
+    list
+        The return value of each job, in order.
+    """
+    if processes == 1:
+        enable_batch()
+        return [_render(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=processes, initializer=enable_batch) as pool:
+        return list(pool.map(_render, jobs))
+
+
+def model_spread(differences):
+    """
+    Standard deviation across models of the per-model differences from calc_gwl_differences
+    """
+    return xr.concat(
+        [diff for model, diff in differences.items() if model != 'Multi-Model Median'],
+        dim='model',
+        compat='override',
+        coords='minimal'
+    ).std(dim='model')
+
+
+def render_paper_figures(out_dir, processes=None, fmt='png', dpi=300):
+    """
+    Renders the map and timeseries figures built from the processed GSAT, SAT
+    and extreme-frequency data to `out_dir`: Figures 1 and S1, the GSAT/GWL
+    panel, hottest and coldest months, piControl statistics, and the
+    multi-model median exceedance frequencies (piControl, each GWL and branch,
+    and the final period), their ramp-down minus ramp-up differences and the
+    inter-model spread of those differences.
+
+    The AMOC, soil moisture and sea ice figures (notebooks 12, 15 and 16) are
+    not included and are still produced by their notebooks.
+    """
+    from matplotlib.colors import BoundaryNorm
+    from cdrmip_extremes import load_data, ext_freq, utils
+    from cdrmip_extremes.configs import data_dir, models
+    from cdrmip_extremes.plotting import plot_extremes, plot_sat
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    def path(name):
+        return os.path.join(out_dir, f"{name}.{fmt}")
+
+    jobs = []
+    save_kw = {'dpi': dpi}
+
+    # GSAT timeseries and 1.5 crossing years
+    gsat = load_data.load_gsat()
+    gwl_years = load_data.load_gwl_years()
+    co2 = load_data.load_co2()
+    gsat_da = plot_sat.concat_gsat(gsat)
+    jobs.append((
+        plot_sat.plot_gsat_figure,
+        (gsat_da, gwl_years, co2),
+        {'save_path': path('gsat_gwls'), **save_kw}
+    ))
+
+    # Figures 1 and S1: SAT change at 1.5°C and over the final 21 years
+    for name, period, diff_period, period_years in [
+        ('figure1', 'gwl', 'tas_15', gwl_years),
+        ('figureS1', 'final', 'tas_equiv_gwl', load_data.load_equiv_gwls()),
+    ]:
+        sat_diff = load_data.load_sat_difference(diff_period)
+        agreement = utils.calc_agreement(sat_diff)
+        sat_diff['Multi-Model Median'] = xr.concat(
+            list(sat_diff.values()),
+            dim='model',
+            compat='override',
+            coords='minimal'
+        ).median(dim='model')
+        jobs.append((
+            plot_sat.plot_figure1,
+            (gsat_da, period_years, co2, sat_diff, agreement, np.linspace(-2, 2, 21)),
+            {'period': period, 'save_path': path(name), **save_kw}
+        ))
+
+    # hottest / coldest months and piControl statistics
+    monthly = load_data.load_monthly_extreme_data()
+    extreme_months = {model: monthly[model]['extreme_months'] for model in models}
+    for extrema, label in [('max', 'Hottest'), ('min', 'Coldest')]:
+        jobs.append((
+            plot_extremes.plot_hottest_coldest_month,
+            (extreme_months, extrema, f"{label} Month"),
+            {'save_path': path(f"{label.lower()}_month"), **save_kw}
+        ))
+    for variable, cmap, vmin, vmax, label, title in [
+        ('max_month_mean', 'RdYlBu_r', -40, 40, 'Temperature (°C)', 'Hottest Month Mean'),
+        ('min_month_mean', 'RdYlBu_r', -40, 40, 'Temperature (°C)', 'Coldest Month Mean'),
+        ('max_month_std_dev', 'viridis', 0, 3, 'Std. Deviation (K)', 'Hottest Month Std. Deviation'),
+        ('min_month_std_dev', 'viridis', 0, 3, 'Std. Deviation (K)', 'Coldest Month Std. Deviation'),
+    ]:
+        jobs.append((
+            plot_extremes.plot_pi_stats,
+            (monthly, variable, cmap, vmin, vmax, label, f"piControl {title}"),
+            {'save_path': path(f"piControl_{variable}"), **save_kw}
+        ))
+
+    # multi-model median extreme frequencies
+    levels = {
+        'heat': {
+            'sigma1': np.linspace(10, 25, 16),
+            'sigma2': np.linspace(0, 10, 21),
+            'sigma3': np.linspace(0, 5, 21),
+        },
+        'cold': {
+            'sigma1': np.linspace(10, 60, 11),
+            'sigma2': np.linspace(10, 60, 11),
+            'sigma3': np.linspace(0, 30, 11),
+        }
+    }
+    norms = {
+        ext_type: {
+            threshold: BoundaryNorm(lev, ncolors=plt.cm.YlOrRd.N, clip=True)
+            for threshold, lev in ext_levels.items()
+        } for ext_type, ext_levels in levels.items()
+    }
+    freq_pi = load_data.load_ext_freq_piControl()['Multi-Model Median']
+    jobs.append((
+        plot_extremes.plot_exceedance_frequencies,
+        (freq_pi['heat_exceedances'], freq_pi['cold_exceedances'], norms,
+         "Multi-Model Median piControl Extreme Temperature Frequency"),
+        {'save_path': path('piControl_ext_freq'), **save_kw}
+    ))
+
+    # multi-model median frequencies at each GWL and in the final period, ramp-down
+    # minus ramp-up differences, and the spread of those differences across models
+    diff_norm = Normalize(vmin=-30, vmax=30)
+    diff_norms = {ext_type: dict.fromkeys(levels[ext_type], diff_norm) for ext_type in levels}
+    spread_norm = Normalize(vmin=0, vmax=30)
+    spread_norms = {ext_type: dict.fromkeys(levels[ext_type], spread_norm) for ext_type in levels}
+    for final in [False, True]:
+        freq = load_data.load_ext_freq_data(final=final)
+        heat_freq = {model: ds_dict['heat_exceedances'] for model, ds_dict in freq.items()}
+        cold_freq = {model: ds_dict['cold_exceedances'] for model, ds_dict in freq.items()}
+        heat_diff, _ = ext_freq.calc_gwl_differences(heat_freq)
+        cold_diff, _ = ext_freq.calc_gwl_differences(cold_freq)
+        heat_spread = model_spread(heat_diff)
+        cold_spread = model_spread(cold_diff)
+
+        median = 'Multi-Model Median'
+        gwls = [None] if final else list(heat_freq[median].gwl.values)
+        for gwl in gwls:
+            sel = {} if gwl is None else {'gwl': gwl}
+            label = 'final' if gwl is None else f"{gwl}"
+            period = 'Final 21 Years' if gwl is None else f"{gwl}°C"
+            for branch in ['ramp_up', 'ramp_down']:
+                jobs.append((
+                    plot_extremes.plot_exceedance_frequencies,
+                    (heat_freq[median].sel(branch=branch, **sel),
+                     cold_freq[median].sel(branch=branch, **sel), norms,
+                     f"Multi-Model Median Extreme Temperature Frequency, {branch} {period}"),
+                    {'save_path': path(f"ext_freq_{label}_{branch}"), **save_kw}
+                ))
+            jobs.append((
+                plot_extremes.plot_exceedance_frequencies,
+                (heat_diff[median].sel(**sel), cold_diff[median].sel(**sel), diff_norms,
+                 f"Multi-Model Median Change in Extreme Frequency (ramp-down - ramp-up), {period}"),
+                {'save_path': path(f"ext_freq_{label}_difference"), 'cmaps': ('RdBu_r', 'RdBu_r'),
+                 'cbar_label': "Change in frequency (%)", **save_kw}
+            ))
+            jobs.append((
+                plot_extremes.plot_exceedance_frequencies,
+                (heat_spread.sel(**sel), cold_spread.sel(**sel), spread_norms,
+                 f"Standard Deviation in Temperature Extreme Frequency Change, {period}"),
+                {'save_path': path(f"ext_freq_{label}_difference_std"), 'cmaps': ('viridis', 'viridis'),
+                 'cbar_label': "Std. Deviation (% change in frequency)", **save_kw}
+            ))
+
+    return render_figures(jobs, processes=processes)
@@ -8,6 +8,8 @@ import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap, BoundaryNorm
 
+from cdrmip_extremes.plotting.batch import map_grid, draw_map, finish
+
 
 cbar_kwargs = {
     "fraction": 0.06,
@@ -21,14 +23,11 @@ cbar_kwargs = {
 def plot_hottest_coldest_month(
     extreme_months,
     extrema,
-    title
+    title,
+    save_path=None,
+    **savefig_kw
 ):
-    fig, axes = plt.subplots(
-        2, 4,
-        subplot_kw={"projection": ccrs.Robinson()},
-        figsize=(16, 6),
-        sharey=True
-    )
+    fig, axes = map_grid(2, 4, figsize=(16, 6), sharey=True)
 
     cmap = plt.cm.twilight_shifted 
     month_labels = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 
@@ -38,17 +37,9 @@ def plot_hottest_coldest_month(
     norm = BoundaryNorm(boundaries, cmap.N, clip=True)
 
     for (model, dt), ax in zip(extreme_months.items(),axes.flat):
-        ds = dt.ds.sel(extrema=extrema).month
-        im = ax.imshow(
-            ds,
-            transform=ccrs.PlateCarree(),
-            cmap=cmap,
-            norm=norm,
-            origin='lower',
-            extent=(0, 360, -90, 90)
-        )
+        ds = getattr(dt, 'ds', dt).sel(extrema=extrema).month
+        im = draw_map(ax, ds, cmap=cmap, norm=norm)
         ax.set_title(model, fontsize=15)
-        ax.coastlines()
 
     # Add a single discrete colorbar for all subplots
     cbar = fig.colorbar(im, ax=axes, boundaries=boundaries, **cbar_kwargs)
@@ -57,7 +48,7 @@ def plot_hottest_coldest_month(
     cbar.set_label("Month", fontsize=12)
     fig.suptitle(title, fontsize=25, y=0.95)
     fig.tight_layout()
-    plt.show()
+    return finish(fig, save_path, **savefig_kw)
 
 def plot_pi_stats(
     ext_dict,
@@ -66,36 +57,79 @@ def plot_pi_stats(
     vmin,
     vmax,
     cbar_label,
-    title
+    title,
+    save_path=None,
+    **savefig_kw
 ):
-    fig, axes = plt.subplots(2,4, subplot_kw={"projection":ccrs.Robinson()},
-                         figsize=(16,6),
-                         sharey=True)
+    fig, axes = map_grid(2, 4, figsize=(16,6), sharey=True)
 
-    cbar_kwargs['label'] = cbar_label
+    cbar_kw = dict(cbar_kwargs, label=cbar_label)
     if 'mean' in variable:
-        cbar_kwargs['extend'] = 'both'
+        cbar_kw['extend'] = 'both'
     else:
-        cbar_kwargs['extend'] = 'max'
+        cbar_kw['extend'] = 'max'
 
     for (model, ds_dict), ax in zip(ext_dict.items(),axes.flat):
         if 'mean' in variable:
             ds = ds_dict[variable] - 273.15
         else:
             ds = ds_dict[variable]
-        im = ax.imshow(
-            ds,
-            transform=ccrs.PlateCarree(),
-            cmap=cmap,
-            origin='lower',
-            vmin=vmin,
-            vmax=vmax,
-            extent=(0, 360, -90, 90)
-        )
+        im = draw_map(ax, ds, cmap=cmap, vmin=vmin, vmax=vmax)
         ax.set_title(model,fontsize=15)
-        ax.coastlines()
-    cbar = fig.colorbar(im,ax=axes,**cbar_kwargs)
+    cbar = fig.colorbar(im,ax=axes,**cbar_kw)
 
     fig.suptitle(title,fontsize=25,y=0.95)
     fig.tight_layout()
-    plt.show()
\ No newline at end of file
+    return finish(fig, save_path, **savefig_kw)
+
+def plot_exceedance_frequencies(
+    heat_freq,
+    cold_freq,
+    norms,
+    title,
+    save_path=None,
+    cmaps=('YlOrRd', 'YlGnBu'),
+    cbar_label="Frequency of occurrence (% of years)",
+    **savefig_kw
+):
+    """
+    Plots heat (top row) and cold (bottom row) exceedance frequency maps for each
+    sigma threshold, with `norms` giving the colour levels per extreme type and threshold.
+    `cmaps` and `cbar_label` allow the same layout for differences or inter-model spread.
+    """
+    heat_symbs = ['1$\\sigma$','2$\\sigma$','3$\\sigma$']
+    cold_symbs = ['-0.25$\\sigma$','-0.5$\\sigma$','-1$\\sigma$']
+    thresholds = ['sigma1','sigma2','sigma3']
+
+    fig, axes = map_grid(2, 3, figsize=(16,8), sharey=True)
+
+    cbar_kw = {"fraction": 0.08, "aspect": 20,
+               'orientation':'horizontal',
+               'location':'bottom','pad':0.04,
+               'anchor':(0.5,-4),
+              }
+
+    rows = [('heat', heat_freq, cmaps[0], heat_symbs), ('cold', cold_freq, cmaps[1], cold_symbs)]
+    for row_index, (ext_type, freq, cmap, symbs) in enumerate(rows):
+        for col_index, threshold in enumerate(thresholds):
+            ax = axes[row_index,col_index]
+            im = draw_map(ax, freq[threshold], cmap=cmap, norm=norms[ext_type][threshold])
+            ax.set_title(f"{symbs[col_index]} Exceedance",fontsize=18)
+
+            cbar = fig.colorbar(im, ax=ax, **cbar_kw)
+            cbar.set_label(cbar_label, fontsize=12)
+            cbar.ax.tick_params(labelsize=12)
+
+    for ax, label in [(axes[0][0], 'Heat Extremes'), (axes[1][0], 'Cold Extremes')]:
+        ax.annotate(label,
+                    xy = (-0.05,0.5),
+                    xycoords="axes fraction",
+                    ha='right',
+                    va='center',
+                    fontsize=20,
+                    rotation=0
+                   )
+
+    fig.suptitle(title,fontsize=24,x=0.58,y=1.0)
+    fig.tight_layout()
+    return finish(fig, save_path, **savefig_kw)
@@ -5,29 +5,54 @@ import pandas as pd
 import netCDF4 as nc
 import numpy as np
 import cartopy.crs as ccrs
+from cartopy.util import add_cyclic_point
+import matplotlib.gridspec as gridspec
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap, BoundaryNorm
 
-# define colour scheme
-colours = ['forestgreen','orange','blue','red','purple','springgreen','pink','dodgerblue']
-colour_dict = {model:colours[i] for i, model in enumerate(models)}
+from cdrmip_extremes.configs import colour_dict
+from cdrmip_extremes.time_index import annual_mean
+from cdrmip_extremes.plotting.batch import finish, draw_map, add_coastlines
 
 
-def plot_gmst_and_gwls(gmst_da,fig,ax):
+def concat_gsat(gsat):
+    """
+    Combines the per-model GSAT timeseries into a single annual DataArray with a 'model' dimension
+    """
+    annual = []
+    for model, gsat_data in gsat.items():
+        if 'year' not in gsat_data.dims:
+            gsat_data = annual_mean(gsat_data)
+        annual.append(gsat_data.assign_coords({'model':model}))
+    return xr.concat(annual,dim='model',compat='override',coords='minimal')
 
-    for model in models:
+
+def plot_gmst_and_gwls(gmst_da,gwl_years,co2,fig,ax,gwl=1.5,period='gwl'):
+    """
+    With period='final', gwl_years is the matched-GWL dataset from load_equiv_gwls
+    and the final 21 years are marked instead of the GWL crossing years
+    """
+
+    for model in gmst_da.model.values:
         da = gmst_da.sel(model=model)
         da_rolling = da.rolling(year=21,center=True,min_periods=1).mean()
         da.plot(ax=ax,color=colour_dict[model],linewidth=2,alpha=0.3)
         da_rolling.plot(ax=ax,label=model,color=colour_dict[model],linewidth=2)
 
-        # plot 1.5 crossing year
-        gwl_up = GWL_crossing_years.sel(model=model).sel(simulation='ramp_up').sel(gwl=1.5)
-        gwl_down = GWL_crossing_years.sel(model=model).sel(simulation='ramp_down').sel(gwl=1.5)
+        if period == 'final':
+            # matched ramp-up GWL and the centre of the final 21 years
+            match = gwl_years.sel(model=model)
+            gwl_up, gwl_up_level = match.year.values, match.tas.values
+            gwl_down, gwl_down_level = 330, gwl_up_level
+        else:
+            # plot gwl crossing year
+            gwl_up = gwl_years[model].sel(branch='ramp_up').sel(gwl=gwl)
+            gwl_down = gwl_years[model].sel(branch='ramp_down').sel(gwl=gwl)
+            gwl_up_level, gwl_down_level = gwl_up.gwl, gwl_down.gwl
 
         ax.scatter(
             gwl_up,
-            gwl_up.gwl,
+            gwl_up_level,
            marker='^',
           color=colour_dict[model],
           s=400,
@@ -35,7 +60,7 @@ def plot_gmst_and_gwls(gmst_da,fig,ax):
             zorder=10
         )
         ax.scatter(gwl_down,
-           gwl_down.gwl,
+           gwl_down_level,
            marker='v',
           color=colour_dict[model],
           s=400,
@@ -56,7 +81,7 @@ def plot_gmst_and_gwls(gmst_da,fig,ax):
     ax.axhline(y = 0, color = 'black',linewidth=1.0)
     
     ax2 = ax.twinx()
-    co2_line = ax2.plot(CO2[100:],
+    co2_line = ax2.plot(co2[100:],
                         label='Atmospheric CO$_2$',
                          color='gray',
                          linewidth=2,
@@ -85,4 +110,68 @@ def plot_gmst_and_gwls(gmst_da,fig,ax):
     ax.legend(handles, labels, loc='upper left', 
               # bbox_to_anchor=(0.5, -0.1), 
               ncol=1, fontsize=12,frameon=False)
-    ax2.legend(handles2,labels2,loc='upper right',ncol=1,fontsize=12,frameon=False)
\ No newline at end of file
+    ax2.legend(handles2,labels2,loc='upper right',ncol=1,fontsize=12,frameon=False)
+
+
+def plot_gsat_figure(gmst_da,gwl_years,co2,save_path=None,**savefig_kw):
+    fig, ax = plt.subplots(figsize=(10,6))
+    plot_gmst_and_gwls(gmst_da,gwl_years,co2,fig,ax)
+    fig.tight_layout()
+    return finish(fig, save_path, **savefig_kw)
+
+
+def plot_figure1(gmst_da,gwl_years,co2,sat_diff,agreement,levels,period='gwl',save_path=None,**savefig_kw):
+    """
+    Figure 1 (period='gwl') and Figure S1 (period='final', with gwl_years from
+    load_equiv_gwls) of notebook 04: GSAT with the GWL periods marked, the
+    multi-model median SAT difference with model agreement stippled, and the
+    SAT difference of each model.
+    sat_diff is the output of load_data.load_sat_difference with a 'Multi-Model Median' entry.
+    """
+    fig = plt.figure(figsize=(24, 14))
+    outer_gs = gridspec.GridSpec(2, 1, height_ratios=[1.2, 1.8], hspace=0.15)
+    top_gs = gridspec.GridSpecFromSubplotSpec(
+        1, 2, subplot_spec=outer_gs[0], wspace=0.2, width_ratios=[1.45, 1]
+    )
+    bottom_gs = gridspec.GridSpecFromSubplotSpec(
+        2, 4, subplot_spec=outer_gs[1], hspace=0.05, wspace=0.05
+    )
+    ax1 = fig.add_subplot(top_gs[0, 0])
+    ax2 = fig.add_subplot(top_gs[0, 1], projection=ccrs.Robinson())
+    map_axes = [fig.add_subplot(bottom_gs[i, j], projection=ccrs.Robinson())
+                for i in range(2) for j in range(4)]
+
+    plot_gmst_and_gwls(gmst_da,gwl_years,co2,fig,ax1,period=period)
+
+    cmap = plt.cm.RdBu_r.copy()
+    cmap.set_extremes(under='midnightblue', over='maroon')
+    norm = BoundaryNorm(levels, ncolors=cmap.N, clip=True)
+    model_list = [model for model in sat_diff if model != 'Multi-Model Median']
+    panels = [(ax2, 'Multi-Model Median', 20)] + [(ax, model, 18) for model, ax in zip(model_list, map_axes)]
+    for ax, name, fontsize in panels:
+        im = draw_map(ax, sat_diff[name].tas, cmap=cmap, norm=norm)
+        add_coastlines(ax)
+        ax.set_title(name, fontsize=fontsize)
+
+    # stipple where models agree on the sign of the change
+    hatch_data, lon = add_cyclic_point(agreement.tas.values, coord=agreement.lon.values)
+    ax2.contourf(
+        lon,
+        agreement.lat.values,
+        hatch_data,
+        transform=ccrs.PlateCarree(),
+        levels=50,
+        colors=[(0,0,0,0.5)],
+        hatches=['/////'],
+        alpha=0
+    )
+
+    cbar_ax = fig.add_axes([0.93,0.1,0.02,0.8])
+    cbar = fig.colorbar(im, cax=cbar_ax, orientation='vertical', extend='both')
+    cbar.ax.tick_params(labelsize=16)
+    cbar.set_label("SAT Difference (°C)", fontsize=18)
+
+    for x, y, label in [(-0.1,1.02,'(a)'), (1.1,1.02,'(b)'), (-0.1,-0.2,'(c)')]:
+        ax1.text(x, y, label, transform=ax1.transAxes, fontsize=20, va='bottom', ha='left')
+
+    return finish(fig, save_path, **savefig_kw)
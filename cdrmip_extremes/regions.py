@@ -0,0 +1,196 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import xarray as xr
+import scipy.sparse as sps
+
+from cdrmip_extremes.configs import data_dir
+from cdrmip_extremes.regrid import target_lat, target_lon, target_bounds, weighted_mean
+
+# land fraction (sftlf, %) on the common 2º grid and reference-region polygons (GeoJSON)
+land_mask_path = os.path.join(data_dir, 'raw/masks/sftlf_r180x90.nc')
+regions_path = os.path.join(data_dir, 'raw/regions/reference_regions.geojson')
+weights_dir = os.path.join(data_dir, 'processed/regions')
+
+default_lat_bands = [(-90, -60), (-60, -30), (-30, 30), (30, 60), (60, 90)]
+
+_cache = {}
+
+
+def cell_areas():
+    """
+    Relative area of each cell of the common grid, shape (lat, lon)
+    """
+    lat_b, lon_b = target_bounds()
+    return np.outer(
+        np.diff(np.sin(np.deg2rad(lat_b)), axis=-1).ravel(),
+        np.diff(lon_b, axis=-1).ravel()
+    )
+
+
+def lat_band_fractions(lat_bands):
+    """
+    Fraction of each cell's area lying in each latitude band, shape (band, lat, lon)
+    """
+    lat_b, _ = target_bounds()
+    s0, s1 = np.sin(np.deg2rad(lat_b[:, 0])), np.sin(np.deg2rad(lat_b[:, 1]))
+    fractions = []
+    for south, north in lat_bands:
+        a, b = np.sin(np.deg2rad(south)), np.sin(np.deg2rad(north))
+        frac = np.clip(np.minimum(b, s1) - np.maximum(a, s0), 0, None) / (s1 - s0)
+        fractions.append(np.broadcast_to(frac[:, None], (len(target_lat), len(target_lon))))
+    return np.stack(fractions)
+
+
+def polygon_fractions(geoms):
+    """
+    Fraction of each cell covered by each polygon, shape (polygon, lat, lon).
+    Polygons may use either -180..180 or 0..360 longitudes.
+    """
+    import shapely
+
+    lat_b, lon_b = target_bounds()
+    lon0, lat0 = np.meshgrid(lon_b[:, 0], lat_b[:, 0])
+    lon1, lat1 = np.meshgrid(lon_b[:, 1], lat_b[:, 1])
+    boxes = shapely.box(lon0.ravel(), lat0.ravel(), lon1.ravel(), lat1.ravel())
+    box_area = shapely.area(boxes)
+    tree = shapely.STRtree(boxes)
+
+    fractions = np.zeros((len(geoms), boxes.size))
+    for k, geom in enumerate(geoms):
+        for shift in [-360, 0, 360]:
+            shifted = shapely.transform(geom, lambda xy: xy + [shift, 0])
+            idx = tree.query(shifted, predicate='intersects')
+            if len(idx) == 0:
+                continue
+            inter = shapely.area(shapely.intersection(boxes[idx], shifted))
+            fractions[k, idx] += inter / box_area[idx]
+    return np.clip(fractions, 0, 1).reshape(len(geoms), len(target_lat), len(target_lon))
+
+
+def read_regions(path=regions_path, name_keys=('Acronym', 'abbrev', 'Name', 'name')):
+    """
+    Reads reference-region polygons from a local GeoJSON file, returning (names, geometries)
+    """
+    import shapely.geometry
+
+    with open(path) as f:
+        features = json.load(f)['features']
+    names, geoms = [], []
+    for i, feature in enumerate(features):
+        props = feature.get('properties') or {}
+        name = next((props[key] for key in name_keys if key in props), f"region{i}")
+        names.append(str(name))
+        geoms.append(shapely.geometry.shape(feature['geometry']))
+    return names, geoms
+
+
+def build_region_weights(land_mask=land_mask_path, regions=regions_path, lat_bands=None):
+    """
+    Rasterises every region onto the common grid as a sparse (region x cell)
+    matrix of area weights. Rows cover the globe, land and ocean (if a land
+    fraction file exists), latitude bands, and reference-region polygons (if a
+    regions file exists).
+    """
+    lat_bands = default_lat_bands if lat_bands is None else lat_bands
+    area = cell_areas()
+    names = ['global']
+    rows = [area]
+
+    if land_mask is not None and os.path.exists(land_mask):
+        land = xr.open_dataarray(land_mask).squeeze(drop=True)
+        land = land.sortby('lat').values / 100 if land.max() > 1 else land.sortby('lat').values
+        land = np.nan_to_num(land)
+        names += ['land', 'ocean']
+        rows += [area * land, area * (1 - land)]
+
+    names += [f"lat_{south}_{north}" for south, north in lat_bands]
+    rows += list(area * lat_band_fractions(lat_bands))
+
+    if regions is not None and os.path.exists(regions):
+        region_names, geoms = read_regions(regions)
+        names += region_names
+        rows += list(area * polygon_fractions(geoms))
+
+    weights = sps.csr_matrix(np.stack([row.ravel() for row in rows]))
+    weights.eliminate_zeros()
+    return weights, names
+
+
+def _inputs_key(land_mask, regions, lat_bands):
+    h = hashlib.sha1()
+    for path in (land_mask, regions):
+        if path is not None and os.path.exists(path):
+            stat = os.stat(path)
+            h.update(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime}".encode())
+        else:
+            h.update(b'none')
+    h.update(json.dumps([list(band) for band in lat_bands]).encode())
+    return h.hexdigest()[:10]
+
+
+def load_region_weights(rebuild=False, land_mask=land_mask_path, regions=regions_path, lat_bands=None):
+    """
+    Returns (weights, names), building and saving the region matrix on first use.
+    The saved matrix is keyed on the land fraction and regions files (path and
+    modification time) and the latitude bands, so adding or changing an input
+    triggers a rebuild.
+    """
+    lat_bands = default_lat_bands if lat_bands is None else lat_bands
+    key = _inputs_key(land_mask, regions, lat_bands)
+    if key in _cache and not rebuild:
+        return _cache[key]
+    path = os.path.join(weights_dir, f"region_weights_{key}.npz")
+    names_path = path.replace('.npz', '_names.json')
+    if os.path.exists(path) and not rebuild:
+        weights = sps.load_npz(path).tocsr()
+        with open(names_path) as f:
+            names = json.load(f)
+    else:
+        weights, names = build_region_weights(land_mask, regions, lat_bands)
+        os.makedirs(weights_dir, exist_ok=True)
+        sps.save_npz(path, weights)
+        with open(names_path, 'w') as f:
+            json.dump(names, f)
+    _cache[key] = (weights, names)
+    return weights, names
+
+
+def regional_mean(x, weights=None, names=None):
+    """
+    Area-weighted mean of a (..., lat, lon) field over every region with a single
+    sparse matrix product. Missing cells are excluded from each region's mean.
+    Works on DataArrays and Datasets, e.g. the output of calculate_exceedances,
+    compare_gwl_means or calc_gwl_differences.
+    """
+    if weights is None:
+        weights, names = load_region_weights()
+    if x['lat'][0] > x['lat'][-1]:
+        x = x.sortby('lat')
+    out = xr.apply_ufunc(
+        weighted_mean,
+        x,
+        kwargs={'weights': weights},
+        input_core_dims=[['lat', 'lon']],
+        output_core_dims=[['region']],
+        dask='parallelized',
+        output_dtypes=[float],
+        dask_gufunc_kwargs={'output_sizes': {'region': weights.shape[0]}},
+    )
+    return out.assign_coords(region=names)
+
+
+def regional_means_by_model(fields, weights=None, names=None):
+    """
+    Reduces a {model: field} dict, such as the differences from calc_gwl_differences,
+    to regional means for all models, GWLs and branches in one product
+    """
+    stacked = xr.concat(
+        [field.assign_coords(model=model) for model, field in fields.items()],
+        dim='model',
+        compat='override',
+        coords='minimal'
+    )
+    return regional_mean(stacked, weights, names)
@@ -0,0 +1,268 @@
+import os
+import hashlib
+
+import numpy as np
+import xarray as xr
+import scipy.sparse as sps
+
+from cdrmip_extremes.configs import data_dir
+
+weights_dir = os.path.join(data_dir, 'processed/regrid_weights')
+
+# common 2º by 2º grid, equivalent to cdo's r180x90
+target_lat = np.arange(-89, 90, 2.0)
+target_lon = np.arange(0, 360, 2.0)
+
+_weights = {}
+
+
+def _centre_bounds(centres, lower=None, upper=None):
+    """
+    Infers cell bounds from cell centres by taking midpoints
+    """
+    centres = np.asarray(centres, dtype=float)
+    mid = 0.5 * (centres[1:] + centres[:-1])
+    first = centres[0] - (mid[0] - centres[0])
+    last = centres[-1] + (centres[-1] - mid[-1])
+    edges = np.concatenate([[first], mid, [last]])
+    if lower is not None:
+        edges = np.clip(edges, lower, upper)
+    return np.stack([edges[:-1], edges[1:]], axis=-1)
+
+
+def target_bounds():
+    return (
+        _centre_bounds(target_lat, -90, 90),
+        _centre_bounds(target_lon),
+    )
+
+
+def _find_coord(ds, names):
+    for name in names:
+        if name in ds.coords or name in ds.variables:
+            return name
+    raise KeyError(f"None of {names} found in dataset. Available: {list(ds.variables)}")
+
+
+def grid_bounds(ds):
+    """
+    Returns (lat_bounds, lon_bounds, curvilinear) describing the source grid of ds.
+
+    For rectilinear grids the bounds have shape (n, 2) and are read from the CF
+    'bounds' attribute where present, otherwise inferred from the cell centres.
+    For curvilinear grids the CMIP6 cell vertices of shape (nj, ni, 4) are used.
+    """
+    lat = _find_coord(ds, ['lat', 'latitude', 'nav_lat'])
+    lon = _find_coord(ds, ['lon', 'longitude', 'nav_lon'])
+
+    if ds[lat].ndim == 1:
+        bounds = []
+        for name, lower, upper in [(lat, -90, 90), (lon, None, None)]:
+            bnds = ds[name].attrs.get('bounds', f"{name}_bnds")
+            if bnds in ds.variables:
+                b = ds[bnds].values
+                b = b[0] if b.ndim == 3 else b
+                bounds.append(np.sort(b, axis=-1).astype(float))
+            else:
+                bounds.append(np.sort(_centre_bounds(ds[name].values, lower, upper), axis=-1))
+        return bounds[0], bounds[1], False
+
+    vlat = _find_coord(ds, ['vertices_latitude', 'lat_bnds', 'latitude_bnds', 'bounds_nav_lat'])
+    vlon = _find_coord(ds, ['vertices_longitude', 'lon_bnds', 'longitude_bnds', 'bounds_nav_lon'])
+    return ds[vlat].values.astype(float), ds[vlon].values.astype(float), True
+
+
+def _lon_overlap(dst, src):
+    """
+    Dense (n_dst, n_src) matrix of longitude overlaps in degrees, allowing for periodicity
+    """
+    a, b = dst[:, 0:1], dst[:, 1:2]
+    overlap = np.zeros((len(dst), len(src)))
+    for shift in [-360, 0, 360]:
+        c, d = src[:, 0] + shift, src[:, 1] + shift
+        overlap += np.clip(np.minimum(b, d) - np.maximum(a, c), 0, None)
+    return overlap
+
+
+def _lat_overlap(dst, src):
+    """
+    Dense (n_dst, n_src) matrix of overlaps in sin(latitude), proportional to area
+    """
+    a, b = np.sin(np.deg2rad(dst[:, 0:1])), np.sin(np.deg2rad(dst[:, 1:2]))
+    c, d = np.sin(np.deg2rad(src[:, 0])), np.sin(np.deg2rad(src[:, 1]))
+    return np.clip(np.minimum(b, d) - np.maximum(a, c), 0, None)
+
+
+def rectilinear_weights(src_lat_b, src_lon_b, dst_lat_b, dst_lon_b):
+    """
+    Exact first-order conservative weights between two rectilinear lat/lon grids.
+    On a sphere the overlap area of two lat/lon cells separates into a longitude
+    term and a sin(latitude) term, so the full matrix is a Kronecker product.
+    """
+    lat_w = _lat_overlap(dst_lat_b, src_lat_b)
+    lon_w = _lon_overlap(dst_lon_b, src_lon_b)
+    overlap = sps.kron(sps.csr_matrix(lat_w), sps.csr_matrix(lon_w), format='csr')
+
+    dst_area = np.outer(
+        np.diff(np.sin(np.deg2rad(dst_lat_b)), axis=-1).ravel(),
+        np.diff(dst_lon_b, axis=-1).ravel()
+    ).ravel()
+    return sps.diags(1 / dst_area) @ overlap
+
+
+def curvilinear_weights(src_vlat, src_vlon, dst_lat_b, dst_lon_b):
+    """
+    First-order conservative weights from a curvilinear grid, described by cell
+    vertices, onto a regular lat/lon grid. Overlaps are computed as polygon
+    intersections in lon/lat space and scaled by cos(latitude) of the
+    intersection centroid.
+    """
+    import shapely
+
+    vlat = src_vlat.reshape(-1, src_vlat.shape[-1])
+    vlon = src_vlon.reshape(-1, src_vlon.shape[-1]).copy()
+
+    # unwrap each cell so it does not straddle the dateline, then move into [0, 360)
+    vlon = vlon[:, :1] + (vlon - vlon[:, :1] + 180) % 360 - 180
+    vlon -= np.floor(vlon[:, :1] / 360) * 360
+
+    dlat = np.diff(dst_lat_b[0])[0]
+    dlon = np.diff(dst_lon_b[0])[0]
+    lat0, lon0 = dst_lat_b[0, 0], dst_lon_b[0, 0]
+    ny, nx = len(dst_lat_b), len(dst_lon_b)
+
+    valid = np.isfinite(vlat).all(axis=1) & np.isfinite(vlon).all(axis=1)
+    src_idx = np.flatnonzero(valid)
+    polys = shapely.polygons(np.stack([vlon[valid], vlat[valid]], axis=-1))
+    polys = shapely.make_valid(polys)
+
+    # candidate destination cells from each polygon's bounding box
+    rows, cols, cells = [], [], []
+    j0 = np.floor((vlat[valid].min(axis=1) - lat0) / dlat).astype(int).clip(0, ny - 1)
+    j1 = np.floor((vlat[valid].max(axis=1) - lat0) / dlat).astype(int).clip(0, ny - 1)
+    i0 = np.floor((vlon[valid].min(axis=1) - lon0) / dlon).astype(int)
+    i1 = np.floor((vlon[valid].max(axis=1) - lon0) / dlon).astype(int)
+    for k in range(len(src_idx)):
+        for j in range(j0[k], j1[k] + 1):
+            for i in range(i0[k], i1[k] + 1):
+                rows.append(j * nx + i % nx)
+                cols.append(k)
+                cells.append((j, i))
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    cells = np.asarray(cells)
+
+    # destination boxes, in the same unwrapped longitude frame as the polygon
+    boxes = shapely.box(
+        lon0 + cells[:, 1] * dlon,
+        dst_lat_b[cells[:, 0], 0],
+        lon0 + (cells[:, 1] + 1) * dlon,
+        dst_lat_b[cells[:, 0], 1],
+    )
+    inter = shapely.intersection(polys[cols], boxes)
+    area = shapely.area(inter)
+    keep = area > 0
+    centroid_lat = shapely.get_y(shapely.centroid(inter[keep]))
+    overlap = area[keep] * np.cos(np.deg2rad(centroid_lat))
+
+    dst_lat_c = dst_lat_b.mean(axis=-1)
+    dst_area = (
+        np.diff(dst_lat_b, axis=-1).ravel()[:, None]
+        * np.diff(dst_lon_b, axis=-1).ravel()[None, :]
+        * np.cos(np.deg2rad(dst_lat_c))[:, None]
+    ).ravel()
+
+    overlap = sps.csr_matrix(
+        (overlap, (rows[keep], src_idx[cols[keep]])),
+        shape=(ny * nx, vlat.shape[0])
+    )
+    return sps.diags(1 / dst_area) @ overlap
+
+
+def _grid_hash(lat_b, lon_b):
+    h = hashlib.sha1()
+    for b in (lat_b, lon_b):
+        h.update(str(b.shape).encode())
+        h.update(np.round(b, 4).astype(np.float32).tobytes())
+    return h.hexdigest()[:10]
+
+
+def get_weights(ds, model):
+    """
+    Returns the sparse (n_target, n_source) conservative remapping matrix for the
+    grid of ds. Weights are computed once per model and source grid, saved to
+    data/processed/regrid_weights and reused across experiments and variables.
+    """
+    lat_b, lon_b, curvilinear = grid_bounds(ds)
+    key = f"{model}_{_grid_hash(lat_b, lon_b)}"
+    if key in _weights:
+        return _weights[key]
+
+    path = os.path.join(weights_dir, f"{key}.npz")
+    if os.path.exists(path):
+        weights = sps.load_npz(path).tocsr()
+    else:
+        dst_lat_b, dst_lon_b = target_bounds()
+        if curvilinear:
+            weights = curvilinear_weights(lat_b, lon_b, dst_lat_b, dst_lon_b)
+        else:
+            weights = rectilinear_weights(lat_b, lon_b, dst_lat_b, dst_lon_b)
+        weights = weights.tocsr()
+        os.makedirs(weights_dir, exist_ok=True)
+        sps.save_npz(path, weights)
+    _weights[key] = weights
+    return weights
+
+
+def weighted_mean(x, weights):
+    """
+    Applies a sparse (n_target, n_cell) weight matrix to the trailing (y, x)
+    dimensions of x, giving shape (..., n_target). Missing values are excluded
+    and each row renormalised by the weight of its valid cells.
+    """
+    lead = x.shape[:-2]
+    flat = x.reshape(-1, x.shape[-2] * x.shape[-1]).T
+    valid = np.isfinite(flat)
+    num = weights @ np.where(valid, flat, 0)
+    den = weights @ valid.astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.where(den > 0, num / den, np.nan)
+    return out.T.reshape(*lead, weights.shape[0])
+
+
+def _apply_weights(x, weights):
+    out = weighted_mean(x, weights)
+    return out.reshape(*x.shape[:-2], len(target_lat), len(target_lon)).astype(x.dtype, copy=False)
+
+
+def regrid(da, weights):
+    """
+    Conservatively remaps a DataArray onto the common 2º grid. The horizontal
+    dimensions are assumed to be the last two; any dask chunking along the other
+    dimensions is preserved so the remap is applied chunk by chunk.
+    """
+    ydim, xdim = da.dims[-2:]
+    if da.chunks is not None:
+        da = da.chunk({ydim: -1, xdim: -1})
+    out = xr.apply_ufunc(
+        _apply_weights,
+        da,
+        kwargs={'weights': weights},
+        input_core_dims=[[ydim, xdim]],
+        output_core_dims=[['lat', 'lon']],
+        exclude_dims={ydim, xdim},
+        dask='parallelized',
+        output_dtypes=[da.dtype],
+        dask_gufunc_kwargs={'output_sizes': {'lat': len(target_lat), 'lon': len(target_lon)}},
+        keep_attrs=True,
+    )
+    drop = [c for c in out.coords if set(out[c].dims) & {ydim, xdim}]
+    return out.drop_vars(drop).assign_coords({'lat': target_lat, 'lon': target_lon})
+
+
+def regrid_dataset(ds, model, var):
+    """
+    Returns ds[var] remapped onto the common 2º grid, using cached weights for the model's grid
+    """
+    weights = get_weights(ds, model)
+    return regrid(ds[var], weights).to_dataset(name=var)
@@ -2,6 +2,21 @@ import xarray as xr
 import numpy as np
 import cftime
 
+from cdrmip_extremes.time_index import annual_mean
+from cdrmip_extremes import kernels
+
+
+def _first_crossing(da, gwl, above=True):
+    if above:
+        return int(da.where(da>=gwl).dropna(dim='year').year[0])
+    return int(da.where(da<=gwl).dropna(dim='year').year[0])
+
+def first_crossing(da, gwl, above=True):
+    """
+    Returns the first year in which da reaches (above=True) or falls to (above=False) gwl
+    """
+    return kernels.dispatch(kernels.first_crossing, _first_crossing, da, gwl, above)
+
 
 def find_crossing_years(
     gsat_da,
@@ -16,8 +31,7 @@ def find_crossing_years(
         rolling = gsat_da.rolling(year=window,center=True,min_periods=1).mean()
     else:
         rolling = (
-            gsat_da
-                .groupby('time.year').mean(dim='time')
+            annual_mean(gsat_da)
                 .rolling(year=window,center=True,min_periods=1).mean()
         )
     crossing_years = {}
@@ -29,14 +43,14 @@ def find_crossing_years(
 
         for gwl in gwls:
             # make mask around specified gwl for each branch and use it to identify crossing years
-            pre_peak_cross = int(pre_peak.where(pre_peak>=gwl).dropna(dim='year').year[0])
-            post_peak_cross = int(post_peak.where(post_peak<=gwl).dropna(dim='year').year[0])
+            pre_peak_cross = first_crossing(pre_peak,gwl,above=True)
+            post_peak_cross = first_crossing(post_peak,gwl,above=False)
             
             crossing_years[gwl] = {'ramp_up':pre_peak_cross,'ramp_down':post_peak_cross}
     else:
         for gwl in gwls:
             # assume we have a warming timeseries
-            cross = int(rolling.where(rolling>=gwl).drop_na(dim='year').year[0])
+            cross = first_crossing(rolling,gwl,above=True)
             crossing_years[gwl] = [cross]
 
     da = xr.DataArray(
@@ -61,8 +75,7 @@ def find_matching_gwls(
         rolling = gsat_da.rolling(year=window,center=True,min_periods=1).mean()
     else:
         rolling = (
-            gsat_da
-                .groupby('time.year').mean(dim='time')
+            annual_mean(gsat_da)
                 .rolling(year=window,center=True,min_periods=1).mean()
         )
     # identify end gwl
@@ -75,7 +88,7 @@ def find_matching_gwls(
     ramp_up = rolling.isel(year=slice(0,140))
 
     # identify crossing year
-    exceed_year = int(ramp_up.where(ramp_up>=end_gwl).dropna(dim='year')['year'][0])
+    exceed_year = first_crossing(ramp_up,end_gwl,above=True)
 
     return [end_gwl, exceed_year]
 
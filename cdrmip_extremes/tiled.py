@@ -0,0 +1,240 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import xarray as xr
+
+from cdrmip_extremes.configs import data_dir, models
+from cdrmip_extremes import ext_freq, utils, kernels, load_data
+
+concat_template = os.path.join(
+    data_dir, 'processed/tas/concatenated/{model}_cdr-reversibility_tas_concat.nc'
+)
+pi_template = os.path.join(
+    data_dir, 'raw/tas/piControl/{model}_piControl_Amon_tas_r180x90.nc'
+)
+extremes_dir = os.path.join(data_dir, 'processed/extremes')
+
+# output periods and the directory suffix each is saved under in data/processed/extremes
+periods = {'gwls': '', 'final': '_final', 'piControl': '_piControl'}
+ext_types = ['heat', 'cold']
+
+
+def make_tiles(tile_shape=(45, 60), nlat=90, nlon=180):
+    """
+    Splits the common grid into (lat slice, lon slice) tiles of at most tile_shape cells
+    """
+    dy, dx = tile_shape
+    return [
+        (slice(j, min(j + dy, nlat)), slice(i, min(i + dx, nlon)))
+        for j in range(0, nlat, dy)
+        for i in range(0, nlon, dx)
+    ]
+
+
+def _open_tile(path, tile):
+    lat, lon = tile
+    with xr.open_dataset(path, drop_variables=['height', 'time_bnds']) as ds:
+        return ds[['tas']].isel(lat=lat, lon=lon).load()
+
+
+def final_years(exceed_year, window=21):
+    """
+    Years covered by the two windows that utils.extract_equiv_gwl_period extracts
+    """
+    return [
+        year for year in range(340)
+        if exceed_year - 10 <= year <= exceed_year + 10 or 340 - window <= year <= 339
+    ]
+
+
+def extremes_chain(tas, pi_tas, gwl_years, final_gwl, exceed_year, window=21):
+    """
+    Runs the extremes chain for one model, from concatenated monthly tas and
+    piControl tas to exceedance frequencies, on whatever part of the grid is passed.
+
+    Extreme months, thresholds and the extreme-month series are all per cell, so
+    a tile gives the same values as the global calculation. The exception is
+    the number of years that calculate_exceedances divides by, which is a mean
+    over the whole grid. The valid-year total and cell count are therefore
+    returned alongside each period's frequencies, so that run_tiled can rescale
+    to the global value.
+
+    The 'final' period is also an exception. extract_equiv_gwl_period drops every
+    year with a missing value anywhere on the grid, so which years are dropped
+    depends on the whole grid. For this period the tile returns the extreme-month
+    series over the two final windows, and the thresholds, without dropping any
+    years. run_tiled assembles these small arrays before the exceedances are calculated.
+    """
+    ext_months = ext_freq.monthly_extrema(pi_tas).assign_coords(extrema=ext_types)
+    thresholds = {}
+    for ext_type, threshold_func in [
+        ('heat', ext_freq.heat_extreme_thresholds),
+        ('cold', ext_freq.cold_extreme_thresholds),
+    ]:
+        months = ext_months.sel(extrema=ext_type).month
+        thresholds[ext_type] = threshold_func(
+            ext_freq.extreme_month_stat(pi_tas, months, 'mean').tas,
+            ext_freq.extreme_month_stat(pi_tas, months, 'std').tas
+        )
+
+    ext_month_tas = ext_freq.select_extreme_month(tas, ext_months)
+    period_tas = {
+        'gwls': utils.extract_gwl_period(ext_month_tas, gwl_years, window),
+        'piControl': ext_freq.select_extreme_month(pi_tas, ext_months),
+    }
+
+    results = {}
+    for period, ds in period_tas.items():
+        counts = ds.tas.count(dim='year')
+        results[period] = {
+            'total': float(counts.sum()),
+            'cells': counts.size,
+        }
+        for ext_type in ext_types:
+            results[period][ext_type] = ext_freq.calculate_exceedances(
+                ds.tas, thresholds[ext_type], ext_type
+            )
+    years = ext_month_tas.year.isin(final_years(exceed_year, window))
+    results['final'] = {
+        'tas': ext_month_tas.sel(year=years),
+        'thresholds': thresholds,
+    }
+    return results
+
+
+def final_exceedances(tile_results, final_gwl, exceed_year, window=21):
+    """
+    Assembles the final-window series and thresholds of every tile and calculates
+    the 'final' exceedance frequencies over the whole grid, so that years are
+    dropped exactly as in the global calculation
+    """
+    ext_month_tas = _combine([r['final']['tas'] for r in tile_results])
+    ds = utils.extract_equiv_gwl_period(ext_month_tas, final_gwl, exceed_year, window)
+    return {
+        f"{ext_type}_exceedances": ext_freq.calculate_exceedances(
+            ds.tas,
+            _combine([r['final']['thresholds'][ext_type] for r in tile_results]),
+            ext_type
+        )
+        for ext_type in ext_types
+    }
+
+
+def _run_tile(model, tile, gwl_years, final_gwl, exceed_year, window, concat_path, pi_path):
+    tas = _open_tile(concat_path.format(model=model), tile)
+    pi_tas = _open_tile(pi_path.format(model=model), tile)
+    return extremes_chain(tas, pi_tas, gwl_years, final_gwl, exceed_year, window)
+
+
+def _init_worker(backend):
+    # one process per core, so the numba kernels should not spawn threads of their own
+    kernels.set_backend(backend)
+    if backend == 'numba':
+        import numba
+        numba.set_num_threads(1)
+
+
+def model_median(exceedances):
+    return xr.concat(
+        list(exceedances),
+        dim='model',
+        compat='override',
+        coords='minimal'
+    ).median(dim='model')
+
+
+def _assemble(tile_results, period, ext_type):
+    total = sum(r[period]['total'] for r in tile_results)
+    cells = sum(r[period]['cells'] for r in tile_results)
+    years = total / cells
+    parts = []
+    for r in tile_results:
+        part = r[period][ext_type]
+        tile_years = r[period]['total'] / r[period]['cells']
+        parts.append(part if tile_years == years else part * (tile_years / years))
+    return _combine(parts)
+
+
+def _combine(parts):
+    # combine_by_coords does not preserve the dimension order of the parts
+    dims = next(iter(parts[0].data_vars.values())).dims
+    return xr.combine_by_coords(parts).transpose(*dims)
+
+
+def run_tiled(
+    model_list=None,
+    tile_shape=(45, 60),
+    processes=None,
+    window=21,
+    gwl_years=None,
+    match_ds=None,
+    concat_path=concat_template,
+    pi_path=pi_template,
+):
+    """
+    Calculates the exceedance frequencies of notebook 06 tile by tile, running the
+    full chain for each (model, tile) in a worker process. Only the tile being
+    processed is ever read, so peak memory per worker is set by tile_shape rather
+    than by the global grid, and the final frequencies are the only arrays assembled.
+
+    Inputs:
+    model_list: models to process, all models by default
+    tile_shape: (lat, lon) size of each tile in grid cells
+    processes: number of worker processes, os.cpu_count() by default
+    gwl_years, match_ds: GWL crossing years and matched GWLs, loaded from data/processed by default
+    Outputs:
+    {period: {model: {'heat_exceedances': ..., 'cold_exceedances': ...}}} for the
+    'gwls', 'final' and 'piControl' periods, including the multi-model 'median'
+    """
+    model_list = models if model_list is None else model_list
+    gwl_years = load_data.load_gwl_years() if gwl_years is None else gwl_years
+    match_ds = load_data.load_equiv_gwls() if match_ds is None else match_ds
+    tiles = make_tiles(tile_shape)
+
+    with ProcessPoolExecutor(
+        processes, initializer=_init_worker, initargs=(kernels.get_backend(),)
+    ) as pool:
+        jobs = {}
+        for model in model_list:
+            match = match_ds.sel(model=model)
+            for i, tile in enumerate(tiles):
+                jobs[model, i] = pool.submit(
+                    _run_tile, model, tile, gwl_years[model].load(),
+                    match.tas.values, match.year.values, window, concat_path, pi_path
+                )
+        results = {key: job.result() for key, job in jobs.items()}
+
+    outputs = {period: {} for period in periods}
+    for period in periods:
+        for model in model_list:
+            tile_results = [results[model, i] for i in range(len(tiles))]
+            if period == 'final':
+                match = match_ds.sel(model=model)
+                outputs[period][model] = final_exceedances(
+                    tile_results, match.tas.values, match.year.values, window
+                )
+                continue
+            outputs[period][model] = {
+                f"{ext_type}_exceedances": _assemble(tile_results, period, ext_type)
+                for ext_type in ext_types
+            }
+        outputs[period]['median'] = {
+            f"{ext_type}_exceedances": model_median(
+                outputs[period][model][f"{ext_type}_exceedances"] for model in model_list
+            )
+            for ext_type in ext_types
+        }
+    return outputs
+
+
+def save_exceedances(outputs, save_dir=extremes_dir):
+    """
+    Saves the output of run_tiled with the layout written by notebook 06, so it
+    can be read back with load_data.load_ext_freq_data and load_ext_freq_piControl
+    """
+    for period, suffix in periods.items():
+        for model, ds_dict in outputs[period].items():
+            for var, ds in ds_dict.items():
+                var_dir = os.path.join(save_dir, f"{var}{suffix}")
+                os.makedirs(var_dir, exist_ok=True)
+                ds.to_netcdf(os.path.join(var_dir, f"{model}_{var}{suffix}.nc"))
@@ -0,0 +1,121 @@
+import numpy as np
+
+# integer calendar coordinates attached along 'time'
+year_coord = 'cal_year'
+month_coord = 'cal_month'
+
+
+def add_calendar_coords(ds, time_dim='time'):
+    """
+    Attaches integer year and month coordinates along the time dimension.
+
+    For a regular monthly axis (as produced by utils.concat_branches) these are
+    derived arithmetically from the first timestep, so only a handful of cftime
+    objects are ever touched. Otherwise the cftime accessor is used once and the
+    result kept on the returned object for all subsequent operations.
+    """
+    if year_coord in ds.coords and month_coord in ds.coords:
+        return ds
+
+    time = ds.indexes[time_dim]
+    n = len(time)
+    first, last, mid = time[0], time[-1], time[n // 2]
+    offset = np.arange(n) + first.month - 1
+    years = first.year + offset // 12
+    months = offset % 12 + 1
+
+    regular = (
+        (last.year, last.month) == (years[-1], months[-1])
+        and (mid.year, mid.month) == (years[n // 2], months[n // 2])
+    )
+    if not regular:
+        years = ds[time_dim].dt.year.values
+        months = ds[time_dim].dt.month.values
+
+    return ds.assign_coords({
+        year_coord: (time_dim, years.astype(np.int32)),
+        month_coord: (time_dim, months.astype(np.int8)),
+    })
+
+
+def drop_calendar_coords(ds):
+    return ds.drop_vars([year_coord, month_coord], errors='ignore')
+
+
+def _is_whole_years(years, months):
+    n = len(months)
+    return (
+        n > 0 and n % 12 == 0 and months[0] == 1
+        and np.array_equal(months, np.arange(n) % 12 + 1)
+        and np.array_equal(years, years[0] + np.arange(n) // 12)
+    )
+
+
+def year_month_view(ds, time_dim='time'):
+    """
+    Returns ds reshaped from (time, ...) to (year, month, ...) with integer
+    coordinates, or None if the time axis does not cover whole calendar years
+    """
+    ds = add_calendar_coords(ds, time_dim)
+    years = ds[year_coord].values
+    months = ds[month_coord].values
+    if not _is_whole_years(years, months):
+        return None
+    view = (
+        drop_calendar_coords(ds)
+        .drop_vars(time_dim)
+        .coarsen({time_dim: 12})
+        .construct({time_dim: ('year', 'month')})
+    )
+    return view.assign_coords(year=years[::12], month=np.arange(1, 13))
+
+
+def month_mask(ds, months, time_dim='time'):
+    """
+    Boolean mask along time equal to ds.time.dt.month == months, computed on integers
+    """
+    ds = add_calendar_coords(ds, time_dim)
+    return ds[month_coord] == months
+
+
+def split_static(ds, time_dim='time'):
+    """
+    Splits a Dataset into its data variables along time_dim and those without it
+    (e.g. lat_bnds), which are returned separately, or None for a DataArray
+    """
+    if not hasattr(ds, 'data_vars'):
+        return ds, None
+    static = [var for var in ds.data_vars if time_dim not in ds[var].dims]
+    return ds.drop_vars(static), ds[static]
+
+
+def merge_static(out, static):
+    return out if static is None else out.assign(static.data_vars)
+
+
+def annual_mean(ds, time_dim='time'):
+    """
+    Equivalent to ds.groupby('time.year').mean(dim='time'), except that data
+    variables without a time dimension are passed through unchanged
+    """
+    ds, static = split_static(ds, time_dim)
+    view = year_month_view(ds, time_dim)
+    if view is not None:
+        return merge_static(view.mean(dim='month'), static)
+    ds = add_calendar_coords(ds, time_dim)
+    years = ds[year_coord].rename('year')
+    return merge_static(drop_calendar_coords(ds).groupby(years).mean(dim=time_dim), static)
+
+
+def monthly_mean(ds, time_dim='time'):
+    """
+    Equivalent to ds.groupby('time.month').mean(dim='time'), except that data
+    variables without a time dimension are passed through unchanged
+    """
+    ds, static = split_static(ds, time_dim)
+    view = year_month_view(ds, time_dim)
+    if view is not None:
+        return merge_static(view.mean(dim='year'), static)
+    ds = add_calendar_coords(ds, time_dim)
+    months = ds[month_coord].astype(int).rename('month')
+    return merge_static(drop_calendar_coords(ds).groupby(months).mean(dim=time_dim), static)
@@ -2,6 +2,9 @@ import xarray as xr
 import numpy as np
 import cftime
 
+from cdrmip_extremes.time_index import add_calendar_coords, annual_mean
+from cdrmip_extremes.regions import load_region_weights, regional_mean, land_mask_path
+
 
 
 def global_mean(x, var="tas"):
@@ -31,14 +34,13 @@ def global_surface_mean(x, var, surface):
     else:
         raise TypeError("Input must be an xarray Dataset or DataArray")
 
-    if surface == 'land':
-        weights=areacella
-    elif surface == 'ocean':
-        weights = areacello
-    else:
+    if surface not in ('land', 'ocean'):
         raise ValueError("surface must be 'land' or 'ocean'")
 
-    return da.weighted(weights=weights).mean(dim=weights.dims)
+    weights, names = load_region_weights()
+    if surface not in names:
+        raise FileNotFoundError(f"No land fraction file found at {land_mask_path}")
+    return regional_mean(da, weights, names).sel(region=surface, drop=True)
 
 def concat_branches(ds_up, ds_down):
     time_up = xr.cftime_range("0000-01-16",freq="1M",periods=12*140,calendar='noleap')
@@ -48,7 +50,7 @@ def concat_branches(ds_up, ds_down):
     ds_up = ds_up.isel(time=slice(None,12*140)).assign_coords({'time':time_up})
     ds_down = ds_down.assign_coords({'time':time_down})
 
-    return xr.concat([ds_up,ds_down],dim='time')
+    return add_calendar_coords(xr.concat([ds_up,ds_down],dim='time'))
 
 def calc_anomaly(
     ds: xr.Dataset,
@@ -76,7 +78,7 @@ def calc_anomaly(
     
 def rolling(ds,window,time_dim='year'):
     if time_dim != 'year':
-        ds = ds.groupby('time.year').mean(dim='time')
+        ds = annual_mean(ds)
     return ds.rolling(year=window,center=True,min_periods=1).mean()
 
 def peak_warming(ds):
@@ -113,7 +115,7 @@ def extract_gwl_period(ds, gwl_years, window, time_dim='year'):
     gwls = gwl_years.gwl.values
 
     if time_dim != 'year':
-        ds = ds.groupby('time.year').mean(dim='time')
+        ds = annual_mean(ds)
     
     def extract_windows(years):
         """Extract windows of `ds` centered on each GWL year."""
@@ -137,7 +139,7 @@ def extract_gwl_period(ds, gwl_years, window, time_dim='year'):
 def extract_equiv_gwl_period(ds,final_gwl,exceed_year,window,time_dim='year'):
 
     if time_dim != 'year':
-        ds = ds.groupby('time.year').mean(dim='time')
+        ds = annual_mean(ds)
         
     # extract final 21-year period and equivalent ramp-up gwl period from ds
     ramp_up = ds.sel(year=slice(exceed_year-10,exceed_year+10)).dropna(dim='year')